@@ -0,0 +1,310 @@
+"""soda benchmark suite
+
+Runs rendering scenarios on the public soda API and reports wall time, per-frame latency
+percentiles and peak memory. Results are saved as JSON and can be compared with a baseline:
+
+    python bench.py --output results.json
+    python bench.py --baseline results.json        # exits with 1 if a scenario got slower or bigger
+
+Every asset is generated on the fly. Text scenarios use the bundled DejaVuSans.ttf,
+another TrueType font can be passed with --font or SODA_BENCH_FONT.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import find_spec
+from multiprocessing import get_context
+from random import Random
+
+from PIL import Image as PImage, __version__ as pillow_version
+
+import soda
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# DejaVu Sans is bundled with the suite, so text scenarios run the same on every machine
+FONT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DejaVuSans.ttf")
+
+
+def font_find(path=None):
+    # returns a path to a TrueType font or None
+    path = path or os.environ.get("SODA_BENCH_FONT") or FONT
+    return path if os.path.exists(path) else None
+
+
+def picture_make(size, seed):
+    # synthetic photo-like RGB image: gradients in every channel and some noise
+    random = Random(seed)
+    channels = [PImage.linear_gradient("L").rotate(random.randint(0, 359)).resize(size) for i in range(3)]
+    image = PImage.merge("RGB", channels)
+    noise = PImage.effect_noise(size, 24).convert("RGB")
+    return PImage.blend(image, noise, 0.2)
+
+
+def mask_make(size):
+    return PImage.radial_gradient("L").resize(size).point(lambda value: 255 - value)
+
+
+# scenarios are generators: the first step sets the scene up, every next step renders one frame
+
+def squares_gif(frames, font):
+    # README example: 1600 squares randomly changing color, streamed to a GIF
+    multiplier = 5
+    canvas = soda.Canvas(size=(42 * multiplier, 42 * multiplier), color="#fff")
+    gif = soda.GIF(canvas, file=io.BytesIO(), framerate=30)
+    squares = []
+    for i in range(1600):
+        squares.append(soda.Rectangle(multiplier, color="#4680c2", position=(multiplier, multiplier)))
+        canvas.put(squares[-1], position=((i % 40) * multiplier, (i // 40) * multiplier))
+    yield
+    for frame in range(frames):
+        for square in squares:
+            square.color_set(soda.hsl())
+        gif()
+        yield
+    gif.close()
+
+
+def text_template(frames, font):
+    # a page of 400 labels made with a Template, every label changes on every frame
+    canvas = soda.Canvas(size=(1200, 800), color="#fff")
+    label = soda.Template(soda.Text, ["text", "position"], font=font, size=14, align="ss", color="#222")
+    texts = [label("item {}".format(i), (10 + (i % 8) * 148, 10 + (i // 8) * 15)) for i in range(400)]
+    for text in texts:
+        canvas.put(text)
+    yield
+    for frame in range(frames):
+        for i, text in enumerate(texts):
+            text.text = "item {}\n{}".format(i, frame) if i % 2 else "item {}: {}".format(i, frame * i)
+        canvas.render()
+        yield
+
+
+def image_masks(frames, font):
+    # photos composited with masks, moving on every frame
+    canvas = soda.Canvas(size=(1000, 1000), color="#000")
+    images = [soda.SodaImage(picture_make((200, 160), i), mask=mask_make((128, 128))) for i in range(6)]
+    shapes = [soda.MaskShape(mask_make((200, 200)), soda.hsl(h=i * 40, s=80, l=60)) for i in range(6)]
+    for i, image in enumerate(images + shapes):
+        canvas.put(image, position=((i % 4) * 240, (i // 4) * 240), label="i{}".format(i))
+    yield
+    for frame in range(frames):
+        for i in range(len(images + shapes)):
+            canvas.move("i{}".format(i), ((i % 4) * 240 + frame % 20, (i // 4) * 240 + frame % 10))
+        canvas.render()
+        yield
+
+
+def fitbox_nesting(frames, font):
+    # shapes wrapped in eight levels of FitBox, the innermost shape changes on every frame
+    canvas = soda.Canvas(size=(800, 800), color="#fff")
+    cores = []
+    for i in range(16):
+        cores.append(soda.Ellipse((50, 50), 50, 30, color=soda.hsl(h=i * 20, s=80, l=50)))
+        box = cores[-1]
+        for depth in range(8):
+            box = soda.FitBox(box, (190 - depth * 10, 190 - depth * 10))
+        canvas.put(box, position=((i % 4) * 200, (i // 4) * 200))
+    yield
+    for frame in range(frames):
+        cores[frame % len(cores)].radius_set(50, 10 + frame % 40)
+        canvas.render()
+        yield
+
+
+def roundrect_layout(frames, font):
+    # dashboard of 600 rounded cards, a few of them change color on every frame
+    canvas = soda.Canvas(size=(1600, 1000), color="#f4f4f4")
+    random = Random(1)
+    cards = []
+    for i in range(600):
+        cards.append(soda.RoundRect(60, 34, random.choice([4, 8, 12]), soda.hsl(h=i % 360, s=50, l=70),
+                                    position=((i % 25) * 64, (i // 25) * 40)))
+        canvas.put(cards[-1])
+    yield
+    for frame in range(frames):
+        for card in random.sample(cards, 20):
+            card.color_set(soda.hsl())
+        canvas.render()
+        yield
+
+
+def large_canvas(frames, font):
+    # 4000x4000 canvas with 5000 mixed shapes, some of them off the canvas
+    canvas = soda.Canvas(size=(4000, 4000), color="#fff")
+    random = Random(2)
+    shapes = []
+    for i in range(5000):
+        x, y = random.uniform(-500, 4200), random.uniform(-500, 4200)
+        if i % 3 == 0:
+            shapes.append(soda.Ellipse((x, y), random.uniform(5, 60), color=soda.hsl()))
+        elif i % 3 == 1:
+            shapes.append(soda.Rectangle(random.uniform(5, 120), random.uniform(5, 120), soda.hsl(), (x, y)))
+        else:
+            shapes.append(soda.Polygon([(x, y), (x + 50, y + 10), (x + 20, y + 60)], soda.hsl()))
+        canvas.put(shapes[-1])
+    yield
+    for frame in range(frames):
+        for shape in random.sample(shapes, 50):
+            shape.color_set(soda.hsl())
+        canvas.render()
+        yield
+
+
+SCENARIOS = {
+    "squares_gif": (squares_gif, 100, False),
+    "text_template": (text_template, 10, True),
+    "image_masks": (image_masks, 50, False),
+    "fitbox_nesting": (fitbox_nesting, 50, False),
+    "roundrect_layout": (roundrect_layout, 30, False),
+    "large_canvas": (large_canvas, 10, False),
+}
+
+
+def percentile(values, share):
+    values = sorted(values)
+    index = (len(values) - 1) * share
+    low = int(index)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+
+def peak_memory():
+    # peak resident set size of the process in kilobytes, None where it can't be measured
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def scenario_run(name, frames, font):
+    function, default, needs_font = SCENARIOS[name]
+    if needs_font and font is None:
+        return {"skipped": "the TrueType font was not found"}
+    steps = function(frames, font)
+    start = time.perf_counter()
+    next(steps)
+    setup = time.perf_counter() - start
+    latencies = []
+    for frame in range(frames):
+        started = time.perf_counter()
+        next(steps)
+        latencies.append(time.perf_counter() - started)
+    steps.close()
+    wall = time.perf_counter() - start
+    return {"frames": frames, "wall": wall, "setup": setup,
+            "mean": sum(latencies) / len(latencies), "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9), "p99": percentile(latencies, 0.99),
+            "peak_rss_kb": peak_memory()}
+
+
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import soda; print(time.perf_counter() - start)"
+
+
+def import_run(runs=7):
+    # time of import soda in fresh interpreters, the first run also writes the bytecode cache and isn't counted
+    folder = os.path.dirname(os.path.abspath(soda.__file__))
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([folder, os.environ.get("PYTHONPATH", "")]))
+    environment.pop("PYTHONDONTWRITEBYTECODE", None)
+    times = []
+    for run in range(runs + 1):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], env=environment, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        times.append(float(output))
+    times = times[1:]
+    result = {"runs": runs, "min": min(times), "p50": percentile(times, 0.5)}
+    print("{:<18} {:>4} runs    min {:8.2f}ms  p50 {:8.2f}ms".format("import", runs, result["min"] * 1000,
+                                                                      result["p50"] * 1000))
+    return result
+
+
+def suite_run(names, scale, font, isolate=True):
+    results = {}
+    for name in names:
+        frames = max(1, int(SCENARIOS[name][1] * scale))
+        if isolate:
+            # a fresh process per scenario, so peak memory is not inherited from the previous ones
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                results[name] = pool.submit(scenario_run, name, frames, font).result()
+        else:
+            results[name] = scenario_run(name, frames, font)
+        report_line(name, results[name])
+    return results
+
+
+def report_line(name, result):
+    if "skipped" in result:
+        print("{:<18} skipped: {}".format(name, result["skipped"]))
+        return
+    print("{:<18} {:>4} frames  wall {:8.3f}s  p50 {:8.2f}ms  p90 {:8.2f}ms  p99 {:8.2f}ms  peak {}".format(
+        name, result["frames"], result["wall"], result["p50"] * 1000, result["p90"] * 1000,
+        result["p99"] * 1000, "{} MB".format(result["peak_rss_kb"] // 1024) if result["peak_rss_kb"] else "n/a"))
+
+
+def compare(results, baseline, threshold):
+    # returns a list of regressions: (scenario, metric, baseline value, current value)
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get("scenarios", {}).get(name)
+        if old is None or "skipped" in old or "skipped" in result:
+            continue
+        if old["frames"] != result["frames"]:
+            print("{:<18} not compared: {} frames in baseline, {} now".format(name, old["frames"], result["frames"]))
+            continue
+        for metric in ("wall", "p50", "p90", "peak_rss_kb"):
+            if old.get(metric) and result.get(metric) and result[metric] > old[metric] * (1 + threshold):
+                regressions.append((name, metric, old[metric], result[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="soda benchmark suite")
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run, all by default: " + ", ".join(SCENARIOS))
+    parser.add_argument("--output", help="file to save results to as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown or growth, 0.1 is 10%%")
+    parser.add_argument("--scale", type=float, default=1, help="multiplier of frame counts")
+    parser.add_argument("--font", help="TrueType font for text scenarios (DejaVuSans.ttf by default)")
+    parser.add_argument("--inline", action="store_true", help="run scenarios in this process")
+    args = parser.parse_args(argv)
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenarios: " + ", ".join(unknown))
+    font = font_find(args.font)
+    imported = import_run()
+    results = suite_run(names, args.scale, font, isolate=not args.inline)
+    report = {"python": platform.python_version(), "pillow": pillow_version,
+              "numpy": find_spec("numpy") is not None, "platform": platform.platform(),
+              "font": font and os.path.basename(font), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "import": imported, "scenarios": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        old = baseline.get("import", {}).get("p50")
+        if old and imported["p50"] > old * (1 + args.threshold):
+            regressions.append(("import", "p50", old, imported["p50"]))
+        for name, metric, old, new in regressions:
+            print("REGRESSION {}: {} {:.4g} -> {:.4g} ({:+.1%})".format(name, metric, old, new, new / old - 1))
+        if regressions:
+            return 1
+        print("no regressions against", args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
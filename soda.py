@@ -1,16 +1,74 @@
-from PIL import ImageColor, ImageFont, Image as PImage, ImageDraw, ImageFilter
+from PIL import ImageColor, ImageFont, Image as PImage, ImageDraw, ImageFilter, ImageFile, ImagePath
+from PIL import GifImagePlugin, PngImagePlugin, ImageChops
 import random
 import io
-from math import sin, cos, pi
+import os
+import struct
+import sys
+import zlib
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from itertools import chain, repeat
+from operator import is_
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from importlib import import_module
+from importlib.util import find_spec, spec_from_file_location, module_from_spec
+from math import sin, cos, pi, floor, ceil
+from colorsys import hls_to_rgb
 from os import path
+from types import ModuleType
 exists = path.exists
-try:
-    import imageio
-except ImportError:
-    pass
+
+
+# name, alias
+class LazyModule:
+    # stands in for a module until one of its attributes is used, then imports it
+    # and replaces itself in the globals of soda, so the cost is paid on first use only
+    def __init__(self, name, alias):
+        self.__name, self.__alias = name, alias
+
+    def __getattr__(self, key):
+        module = import_module(self.__name)
+        globals()[self.__alias] = module
+        return getattr(module, key)
+
+    def __repr__(self):
+        return "<lazy module {!r}>".format(self.__name)
+
+
+def lazy_import(name, alias=None):
+    # returns None if the module is not installed
+    alias = alias or name.rpartition(".")[2]
+    parent = name.rpartition(".")[0]
+    try:
+        # finding a submodule imports its package, so only the package is looked up if it's not imported yet
+        found = find_spec(name if not parent or parent in sys.modules else name.partition(".")[0]) is not None
+    except (ImportError, ValueError):
+        found = False
+    return LazyModule(name, alias) if found else None
+
+
+def is_array(value):
+    # a value can only be a numpy array if numpy was imported by someone, so this never imports it
+    return "numpy" in sys.modules and numpy is not None and isinstance(value, numpy.ndarray)
+
+
+# optional and heavy modules are imported on first use
+numpy = lazy_import("numpy")
+imageio = lazy_import("imageio")
+json = lazy_import("json")
+base64 = lazy_import("base64")
+hashlib = lazy_import("hashlib")
+shared_memory = lazy_import("multiprocessing.shared_memory")
+resource_tracker = lazy_import("multiprocessing.resource_tracker")
+_webp = lazy_import("PIL._webp", "_webp")
 
 script_path = path.dirname(path.abspath(__file__)) + "/"
 modules = []
+version_clock = 0
 
 class Utils:
     @staticmethod
@@ -27,6 +85,72 @@ class Utils:
         return angle * pi / 180
 
 
+# maxsize[, weigh]
+class LRUCache:
+    # maxsize is a number of items, or a total weight of items if weigh(value) is passed
+    def __init__(self, maxsize=128, weigh=None):
+        self.items = OrderedDict()
+        self.maxsize = maxsize
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, create):
+        # returns a cached value of the key, create() is called on miss
+        with self.lock:
+            if key in self.items:
+                self.hits += 1
+                self.items.move_to_end(key)
+                return self.items[key]
+            self.misses += 1
+        value = create()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.weight -= self.weight_get(self.items.pop(key))
+            self.items[key] = value
+            self.weight += self.weight_get(value)
+            self.evict()
+
+    def weight_get(self, value):
+        return 1 if self.weigh is None else self.weigh(value)
+
+    def evict(self):
+        while self.items and self.weight > self.maxsize:
+            self.weight -= self.weight_get(self.items.popitem(last=False)[1])
+
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.weight = 0
+            self.hits = self.misses = 0
+
+    def cache_info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.items),
+                "weight": self.weight, "maxsize": self.maxsize}
+
+    def __len__(self):
+        return len(self.items)
+
+
+fonts = LRUCache(64)
+
+
+def font_get(path, size, index=0, layout_engine=None):
+    # loads a TrueType font once per process, fonts.resize(n) changes the number of kept fonts
+    return fonts.get((path, size, index, layout_engine),
+                     lambda: ImageFont.truetype(path, size, index=index, layout_engine=layout_engine))
+
+
 def fit(box_size, shape_size):
     return min([box_size[0] / shape_size[0], box_size[1] / shape_size[1]])
 
@@ -41,22 +165,84 @@ def hsl(h=None, s=None, l=None):
         return random.randint(*[int(x) for x in (x or [0, maxx])]) % (maxx + 1)
 
     args = [getval(args[i], argsmax[i]) for i in range(3)]
-    return Color.parse("hsl({}, {}%, {}%)".format(*args))
+    return hsl_to_rgba(*args)
+
 
+def hsl_to_rgba(h, s, l):
+    # same rounding as PIL.ImageColor for "hsl(h, s%, l%)" strings, without building and parsing one
+    rgb = hls_to_rgb(float(h) / 360, float(l) / 100, float(s) / 100)
+    return int(rgb[0] * 255 + 0.5), int(rgb[1] * 255 + 0.5), int(rgb[2] * 255 + 0.5), 255
 
-def mask_resize(shape, mask):
-    mask_ = PImage.new("L", shape.size)
-    k = fit(shape.size, mask.size)
+
+# resized masks, the weight is a number of mask bytes
+masks = LRUCache(32 << 20, weigh=lambda mask: mask.size[0] * mask.size[1])
+
+
+def mask_resize(shape, mask, resample=PImage.LANCZOS, key=None):
+    # fits the mask into the size of shape (a shape, an image or a (width, height) tuple) and centers it
+    # with a key that identifies the pixels of the mask, the result is kept in masks and shared, so don't modify it
+    size = tuple(shape) if isinstance(shape, (tuple, list)) else shape.size
+    if key is not None:
+        return masks.get((key, size, resample), lambda: mask_resize(size, mask, resample))
+    mask_ = PImage.new("L", size)
+    k = fit(size, mask.size)
     mask = mask.resize(
-        (int(mask.size[0] * k), int(mask.size[1] * k)), resample=PImage.LANCZOS)
+        (int(mask.size[0] * k), int(mask.size[1] * k)), resample=resample)
     m_position = [0, 0]
     for i in range(2):
-        if mask.size[i] != shape.size[i]:
-            m_position[i] = (shape.size[i] - mask.size[i]) // 2
+        if mask.size[i] != size[i]:
+            m_position[i] = (size[i] - mask.size[i]) // 2
     mask_.paste(mask, m_position)
     return mask_
 
 
+def tick():
+    # advances the global change counter, every change of a shape or color gets a new value
+    global version_clock
+    version_clock += 1
+    return version_clock
+
+
+def changed(source):
+    # tells the object lists watching a shape, color or point that it changed (see ObjectList.watch),
+    # _watchers is a weak reference to the only list or {id(list): weak reference} for more
+    watchers = source._watchers
+    if watchers is None:
+        return
+    if type(watchers) is weakref.ref:
+        watcher = watchers()
+        if watcher is None:
+            object.__setattr__(source, "_watchers", None)
+        else:
+            watcher.source_changed(source)
+        return
+    for key, ref in list(watchers.items()):
+        watcher = ref()
+        if watcher is None:
+            del watchers[key]
+        else:
+            watcher.source_changed(source)
+
+
+def latest_version(*objects):
+    return max([0] + [obj.version_get() for obj in objects if hasattr(obj, "version_get")])
+
+
+def make_bounds(x0, y0, x1, y1, pad=1):
+    # (x0, y0, x1, y1) box rounded outwards, pad covers antialiasing and rounding of PIL
+    # PIL truncates coordinates toward zero, so the far edge is taken from the truncated value (a polygon
+    # up to x = -1.5 is drawn up to x = -1 and may get the pixel after it)
+    return floor(x0) - pad, floor(y0) - pad, int(x1) + 1 + pad, int(y1) + 1 + pad
+
+
+def bounds_union(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def bounds_intersect(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
 def get_point(pointy):
     if isinstance(pointy, Point):
         return pointy
@@ -64,22 +250,50 @@ def get_point(pointy):
         return Point(*pointy)
 
 
+colors = LRUCache(1024)
+
+
 class Color:
+    __slots__ = ("red", "green", "blue", "opacity", "_version", "_watchers")
+
     def __init__(self, color):
-        self.change(color)
+        # new colors start at version 0 with no watchers like points, the slots are set through their
+        # descriptors (color_setters), Color.__setattr__ and change() would tick the clock
+        set_red, set_green, set_blue, set_opacity, set_version, set_watchers = color_setters
+        color = Color.parse(color)
+        set_red(self, color[0])
+        set_green(self, color[1])
+        set_blue(self, color[2])
+        set_opacity(self, color[3] if len(color) > 3 else 255)
+        set_version(self, 0)
+        set_watchers(self, None)
+
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+        if attr[0] != "_":
+            object.__setattr__(self, "_version", tick())
+            changed(self)
+
+    def version_get(self):
+        return self._version
 
     def change(self, color):
         color = Color.parse(color)
-        if len(color) == 4:
-            self.red, self.green, self.blue, self.opacity = color
-        else:
-            self.red, self.green, self.blue, self.opacity = color, 255
+        if len(color) != 4:
+            color = tuple(color) + (255,)
+        for attr, value in zip(("red", "green", "blue", "opacity"), color):
+            object.__setattr__(self, attr, value)
+        object.__setattr__(self, "_version", tick())
+        changed(self)
 
     @staticmethod
     def parse(col):
+        # parsed strings are kept in the soda.colors cache
         if isinstance(col, Color):
             return col.color
-        return tuple(col[:4] if type(col) != str else ImageColor.getrgb(col) + (255,))
+        if type(col) == str:
+            return colors.get(col, lambda: (ImageColor.getrgb(col) + (255,))[:4])
+        return tuple(col[:4])
 
     @property
     def hexval(self):
@@ -90,6 +304,9 @@ class Color:
         return self.red, self.green, self.blue, self.opacity
 
     def __getattr__(self, attr):
+        # color.blue is a new color of that name, private and special names (asked by copy and pickle) aren't
+        if attr[0] == "_":
+            raise AttributeError(attr)
         return Color(attr)
 
     def __getitem__(self, item):
@@ -98,10 +315,82 @@ class Color:
     def __str__(self):
         return "soda.Color(): r{}g{}b{}a{} ({})".format(*self.color, self.hexval)
 
+    def __getstate__(self):
+        return slots_state(self)
+
+    def __setstate__(self, state):
+        state_set(self, state)
+
+
+color_setters = tuple(Color.__dict__[name].__set__ for name in Color.__slots__)
+
+
+def slots_state(obj):
+    # state of a shape or color for copies and pickles, the watchers (object lists of the original)
+    # are left behind
+    state = dict(getattr(obj, "__dict__", ()))
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get("__slots__", ()):
+            try:
+                # read through the slot itself, a subclass may shadow it with a property (Vertex)
+                state[name] = cls.__dict__[name].__get__(obj)
+            except AttributeError:
+                pass
+    state.pop("_watchers", None)
+    return state
+
+
+def state_set(obj, state):
+    # sets the state without ticking the clock, a copy has the version of its original
+    for attr, value in state.items():
+        object.__setattr__(obj, attr, value)
+    object.__setattr__(obj, "_watchers", None)
+
 
 class Shape:
+    __slots__ = ()
     draw_type = "shape"
     color = None
+    _version = 0
+    _watchers = None
+
+    def __setattr__(self, attr, value):
+        # public attributes are the state of the shape, setting one marks the shape as changed
+        object.__setattr__(self, attr, value)
+        if attr[0] != "_":
+            object.__setattr__(self, "_version", tick())
+            changed(self)
+
+    def touch(self):
+        # marks the shape as changed after an in-place change of its state
+        object.__setattr__(self, "_version", tick())
+        changed(self)
+
+    def version_get(self):
+        # returns a number that changes whenever the shape, its color or its position changes
+        version = self._version
+        if self.color is not None:
+            version = max(version, self.color._version)
+        position = getattr(self, "position", None)
+        if isinstance(position, Shape):
+            version = max(version, position.version_get())
+        return version
+
+    def sources_get(self):
+        # returns the objects whose changes change the shape, the ones version_get looks at,
+        # None if they can't be listed, then canvases check the version of the shape on every frame
+        if type(self).version_get is not Shape.version_get:
+            return None
+        return self.sources_own()
+
+    def sources_own(self):
+        sources = [self]
+        if self.color is not None:
+            sources.append(self.color)
+        position = getattr(self, "position", None)
+        if isinstance(position, Shape):
+            sources.append(position)
+        return sources
 
     def color_set(self, color):
         if isinstance(color, Color):
@@ -110,7 +399,7 @@ class Shape:
             self.color = Color(color)
 
     def color_get(self):
-        return (self.color or Color("red")).color
+        return self.color.color if self.color is not None else (255, 0, 0, 255)
 
     # next methods must be implemented in any shape
 
@@ -118,6 +407,11 @@ class Shape:
         # returns size of shape's bounding box: (width, height)
         return (0, 1)
 
+    def bounds_get(self, position):
+        # returns (x0, y0, x1, y1) box the shape covers on the canvas when rendered at position
+        # None means the box is unknown and the whole canvas should be considered covered
+        return None
+
     def render(self, draw, position):
         # renders shape on the canvas
         pass
@@ -130,13 +424,30 @@ class Shape:
         # returns a k times bigger shape
         return self
 
+    def preview_get(self, k):
+        # returns a k times bigger shape for previews, it may be coarser than resized(k)
+        return self.resized(k)
+
+    def __getstate__(self):
+        return slots_state(self)
+
+    def __setstate__(self, state):
+        state_set(self, state)
+
 
 class Point(Shape):
+    __slots__ = ("x", "y", "color", "_version", "_watchers")
     draw_type = "image"
 
     def __init__(self, x, y):
-        self.x = self.y = 0
-        self.move(x, y)
+        # new points start at version 0, only changes of a point advance the clock, the slots are set
+        # through their descriptors (point_setters), faster than object.__setattr__
+        set_x, set_y, set_color, set_version, set_watchers = point_setters
+        set_x(self, x)
+        set_y(self, y)
+        set_color(self, None)
+        set_version(self, 0)
+        set_watchers(self, None)
 
     def move(self, x=None, y=None):
         self.x = Utils.default(x, self.x)
@@ -161,67 +472,245 @@ class Point(Shape):
         draw.putpixel(*position, color=self.color_get())
 
     def rotate(self, center, angle):
-        angle = Utils.deg_to_rad(angle)
-        x = cos(angle) * (self.x - center.x) - sin(angle) * (self.y - center.y) + center.x
-        y = sin(angle) * (self.x - center.x) + cos(angle) * (self.y - center.y) + center.y
+        (x, y), = Transform.rotation(angle, (center.x, center.y)).apply([[self.x, self.y]])
         return Point(x, y)
 
 
+point_setters = tuple(Point.__dict__[name].__set__ for name in Point.__slots__)
+
+
+# [matrix]
+class Transform:
+    # affine transform (x, y) -> (a * x + b * y + c, d * x + e * y + f), matrix is (a, b, c, d, e, f)
+    def __init__(self, matrix=(1, 0, 0, 0, 1, 0)):
+        self.matrix = tuple(matrix)
+
+    @staticmethod
+    def translation(x, y):
+        return Transform((1, 0, x, 0, 1, y))
+
+    @staticmethod
+    def rotation(angle, center=(0, 0)):
+        angle = Utils.deg_to_rad(angle)
+        c, s = cos(angle), sin(angle)
+        x, y = center[0], center[1]
+        return Transform((c, -s, x - c * x + s * y, s, c, y - s * x - c * y))
+
+    @staticmethod
+    def scaling(kx, ky=None, center=(0, 0)):
+        ky = Utils.default(ky, kx)
+        return Transform((kx, 0, center[0] * (1 - kx), 0, ky, center[1] * (1 - ky)))
+
+    def __matmul__(self, other):
+        # (self @ other) applies other first
+        a, b, c, d, e, f = self.matrix
+        a_, b_, c_, d_, e_, f_ = other.matrix
+        return Transform((a * a_ + b * d_, a * b_ + b * e_, a * c_ + b * f_ + c,
+                          d * a_ + e * d_, d * b_ + e * e_, d * c_ + e * f_ + f))
+
+    def apply(self, vertices):
+        # transforms a (n, 2) numpy array or a list of [x, y] in one call
+        a, b, c, d, e, f = self.matrix
+        if is_array(vertices):
+            return vertices @ numpy.array([[a, d], [b, e]], dtype=float) + (c, f)
+        return [[a * x + b * y + c, d * x + e * y + f] for x, y in vertices]
+
+    def __str__(self):
+        return "soda.Transform({})".format(self.matrix)
+
+
+def vertices_make(points):
+    # polygons with many vertices are kept in numpy arrays, small ones in lists
+    if is_array(points):
+        return points.astype(float).reshape(-1, 2)
+    vertices = [[point.x, point.y] if isinstance(point, Point) else [point[0], point[1]] for point in points]
+    if numpy is not None and len(vertices) >= Polygon.array_from:
+        return numpy.array(vertices, dtype=float)
+    return vertices
+
+
+class Vertex(Point):
+    # point view of a polygon vertex, moving it changes the polygon
+    __slots__ = ("_polygon", "_index")
+
+    def __init__(self, polygon, index):
+        object.__setattr__(self, "_polygon", polygon)
+        object.__setattr__(self, "_index", index)
+        object.__setattr__(self, "color", None)
+        object.__setattr__(self, "_version", 0)
+        object.__setattr__(self, "_watchers", None)
+
+    def value_get(self, axis):
+        # the stored value, ints of list vertices stay ints, numpy rows give python floats
+        value = self._polygon._vertices[self._index][axis]
+        return value.item() if is_array(self._polygon._vertices) else value
+
+    @property
+    def x(self):
+        return self.value_get(0)
+
+    @x.setter
+    def x(self, value):
+        self._polygon.vertex_set(self._index, 0, value)
+
+    @property
+    def y(self):
+        return self.value_get(1)
+
+    @y.setter
+    def y(self, value):
+        self._polygon.vertex_set(self._index, 1, value)
+
+
 # points[, color]
 class Polygon(Shape):
+    array_from = 64
+
     def __init__(self, points, color=(0, 0, 0, 255)):
         self.color_set(color)
-        self.points = tuple(get_point(point) for point in points)
+        self.points = points
+
+    @property
+    def points(self):
+        return tuple(Vertex(self, i) for i in range(len(self._vertices)))
+
+    @points.setter
+    def points(self, points):
+        self._vertices = vertices_make(points)
+
+    def vertex_set(self, index, axis, value):
+        self._vertices[index][axis] = value
+        self.touch()
+
+    @property
+    def vertices(self):
+        # (n, 2) numpy array (or list of [x, y] without numpy) of vertices, set it to replace them
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, vertices):
+        self.points = vertices
+
+    def extremes_get(self):
+        # returns (min_x, min_y, max_x, max_y) of vertices
+        vertices = self._vertices
+        if is_array(vertices):
+            return tuple(vertices.min(0).tolist() + vertices.max(0).tolist())
+        xs, ys = [vertex[0] for vertex in vertices], [vertex[1] for vertex in vertices]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def flat_get(self, pos):
+        # returns vertices at the position as a flat [x0, y0, x1, y1...] list
+        vertices = self._vertices
+        if is_array(vertices):
+            return (vertices + (pos.x, pos.y)).ravel().tolist()
+        x, y = pos.x, pos.y
+        return [value for vertex in vertices for value in (vertex[0] + x, vertex[1] + y)]
 
     def to_list(self, pos):
-        return [(point.x + pos.x, point.y + pos.y) for point in self.points]
+        flat = self.flat_get(pos)
+        return list(zip(flat[::2], flat[1::2]))
 
     def render(self, draw, position):
-        draw.polygon(self.to_list(position), fill=self.color_get())
+        draw.polygon(self.flat_get(position), fill=self.color_get())
 
     def box_get(self):
-        xs, ys = sorted([point.x for point in self.points]), sorted([point.y for point in self.points])
-        return xs[-1] - xs[0], ys[-1] - ys[0]
+        x0, y0, x1, y1 = self.extremes_get()
+        return x1 - x0, y1 - y0
+
+    def bounds_get(self, position):
+        x0, y0, x1, y1 = self.extremes_get()
+        return make_bounds(x0 + position.x, y0 + position.y, x1 + position.x, y1 + position.y)
 
     def __str__(self):
         return "soda.Polygon({})".format("; ".join(["({}, {})".format(point.x, point.y) for point in self.points]))
 
+    def transformed(self, transform):
+        return Polygon(transform.apply(self._vertices), self.color)
+
+    def transform(self, transform):
+        # applies an affine Transform to all vertices at once
+        self.vertices = transform.apply(self._vertices)
+
+    def translate(self, x, y):
+        self.transform(Transform.translation(x, y))
+
+    def scale(self, kx, ky=None, center=None):
+        # scales around center, the top-left corner of the polygon by default
+        center = Utils.default(center, self.extremes_get()[:2])
+        self.transform(Transform.scaling(kx, ky, center))
+
     def resized(self, k):
-        position = min([point.x for point in self.points]), min([point.y for point in self.points])
-        points = []
-        for point in self.points:
-            points.append(Point((point.x - position[0]) * k + position[0],
-                            (point.y - position[1]) * k + position[1]))
-        return Polygon(points, self.color)
+        return self.transformed(Transform.scaling(k, k, self.extremes_get()[:2]))
 
     def rotated(self, center, angle):
         center = get_point(center)
-        return Polygon([point.rotate(center, angle) for point in self.points], self.color)
+        return self.transformed(Transform.rotation(angle, (center.x, center.y)))
 
     def rotate(self, center, angle):
-        self.points = self.rotated(center, angle).points
+        center = get_point(center)
+        self.transform(Transform.rotation(angle, (center.x, center.y)))
+
+    @staticmethod
+    def transform_all(polygons, transform):
+        # transforms a group of polygons with one call
+        polygons = list(polygons)
+        if numpy is None:
+            for polygon in polygons:
+                polygon.transform(transform)
+            return
+        arrays = [numpy.asarray(polygon.vertices, dtype=float).reshape(-1, 2) for polygon in polygons]
+        result = transform.apply(numpy.concatenate(arrays)) if arrays else None
+        start = 0
+        for polygon, array in zip(polygons, arrays):
+            part = result[start:start + len(array)]
+            polygon.vertices = part if len(part) >= Polygon.array_from else part.tolist()
+            start += len(array)
 
 
 class RoundRect(Polygon):
+    # corner masks are kept per size, radius and subpixel offset, the weight is a number of mask bytes
+    masks = LRUCache(16 << 20, weigh=lambda mask: mask.size[0] * mask.size[1])
+
     def __init__(self, width, height=None, radius=0, color=(0, 0, 0, 255), position=(0, 0)):
+        self._shapes = self._shapes_key = None
         self.size = [width, Utils.default(height, width)]
         self.color_set(color)
         self.radius = radius if type(radius) != int else [radius] * 4
         self.position = position
 
+    def __setattr__(self, attr, value):
+        # size, radius and position are kept in tuples, so they change only when they are set
+        if attr in ("size", "radius") or attr == "position" and isinstance(value, list):
+            value = tuple(value)
+        super().__setattr__(attr, value)
+
     def radius_limiter(self):
+        # returns the radii scaled down so that the corners fit the sides they share
+        radius = list(self.radius)
         for corner in range(4):
-            s = self.radius[corner] + self.radius[(corner + 1) % 4]
+            s = radius[corner] + radius[(corner + 1) % 4]
             if s > self.size[corner % 2]:
-                k = self.radius[corner] / s
-                self.radius[corner] = self.size[corner % 2] * k
-                self.radius[(corner + 1) % 4] = self.size[corner % 2] * (1 - k)
+                k = radius[corner] / s
+                radius[corner] = self.size[corner % 2] * k
+                radius[(corner + 1) % 4] = self.size[corner % 2] * (1 - k)
+        return radius
 
     def box_get(self):
-        return self.construct()[-1].box_get()
+        return self.shapes_get()[-1].box_get()
+
+    def bounds_get(self, position):
+        x, y = position.x + self.position[0], position.y + self.position[1]
+        return make_bounds(x, y, x + self.size[0], y + self.size[1])
+
+    def version_get(self):
+        return Shape.version_get(self)
+
+    def sources_get(self):
+        return self.sources_own()
 
     def construct(self):
-        self.radius_limiter()
+        radius = self.radius_limiter()
         shapes = []
         points = [0] * 8
         for corner in range(4):
@@ -229,19 +718,51 @@ class RoundRect(Polygon):
             cond = bool(corner % 3), corner > 1
             for subcorner in range(2):
                 d = [cond[subcorner] * self.size[subcorner],
-                     (-1) ** cond[1 - subcorner] * self.radius[corner] + cond[1 - subcorner] * self.size[1 - subcorner]]
+                     (-1) ** cond[1 - subcorner] * radius[corner] + cond[1 - subcorner] * self.size[1 - subcorner]]
                 d = d[::(-1) ** subcorner]
                 points[corner * 2 + (corner % 2 != subcorner)] = Point(*d)
                 center[1 - subcorner] = d[1 - subcorner] + self.position[1 - subcorner]
-            shapes.append(Pieslice(center, self.radius[corner], color=self.color, start=90 * (1 - corner), stop=90 * (2 - corner)))
+            shapes.append(Pieslice(center, radius[corner], color=self.color, start=90 * (1 - corner), stop=90 * (2 - corner)))
         for point in points:
             point.move(point.x + self.position[0], point.y + self.position[1])
         shapes.append(Polygon(points, self.color))
         return shapes
 
+    def shapes_get(self):
+        # returns construct() result, rebuilt only when size, radius, position or color change
+        key = (tuple(self.size), tuple(self.radius), tuple(self.position), self.color)
+        if self._shapes_key != key:
+            self._shapes = self.construct()
+            self._shapes_key = (tuple(self.size), tuple(self.radius), tuple(self.position), self.color)
+        return self._shapes
+
+    def mask_get(self):
+        # returns an "L" mask of the shape with one pixel of margin on each side
+        def create():
+            mask = PImage.new("L", (ceil(self.size[0]) + 3, ceil(self.size[1]) + 3))
+            draw = ImageDraw.Draw(mask)
+            position = Point(1 - self.position[0], 1 - self.position[1])
+            *pieslices, polygon = self.shapes_get()
+            for pieslice in pieslices:
+                draw.pieslice(pieslice.to_list(position), pieslice.stop, pieslice.start, fill=255)
+            draw.polygon(polygon.flat_get(position), fill=255)
+            return mask
+        return self.masks.get((tuple(self.size), tuple(self.radius)), create)
+
     def render(self, draw, position):
-        for shape in self.construct():
-            shape.render(draw, position)
+        # with whole pixel geometry one masked fill gives the same pixels as four pieslices and a polygon
+        shapes = self.shapes_get()
+        values = chain(self.size, self.radius, self.position, (position.x, position.y))
+        if draw.mode not in ("RGB", "RGBA") or any(value != int(value) for value in values):
+            for shape in shapes:
+                shape.render(draw, position)
+            return
+        x, y = int(position.x + self.position[0]), int(position.y + self.position[1])
+        draw.bitmap((x - 1, y - 1), self.mask_get(), fill=self.color_get())
+
+    def resized(self, k):
+        return RoundRect(self.size[0] * k, self.size[1] * k, [radius * k for radius in self.radius], self.color,
+                         self.position)
 
 
 # center, x_radius[, y_radius, color]
@@ -267,6 +788,16 @@ class Ellipse(Shape):
     def box_get(self):
         return (self.x_radius * 2, self.y_radius * 2)
 
+    def bounds_get(self, position):
+        coords = self.to_list(position)
+        return make_bounds(*coords[0], *coords[1])
+
+    def version_get(self):
+        return max(Shape.version_get(self), self.center._version)
+
+    def sources_get(self):
+        return self.sources_own() + [self.center]
+
     def __str__(self):
         if self.x_radius == self.y_radius:
             return "soda.Ellipse(center: {}, radius: {})".format(self.center, self.x_radius)
@@ -306,6 +837,12 @@ class Pieslice(Ellipse):
 
 # text, font, size[, position, align, color]
 class Text(Shape):
+    # masks of the drawn text are kept per text, font, align, font mode and subpixel offset,
+    # the weight is a number of mask bytes; sizes are kept per text and font
+    bitmaps = LRUCache(32 << 20, weigh=lambda bitmap: bitmap[1].size[0] * bitmap[1].size[1] + 1)
+    sizes = LRUCache(4096)
+    aligns = {"c": "center", "s": "left", "e": "right"}
+
     def __init__(self, text, font, size=1000, position=Point(0, 0), align="cs", color=(0, 0, 0, 255)):
         self.text = text
         self.font_set(font, size)
@@ -314,7 +851,7 @@ class Text(Shape):
         self.align = align
 
     def font_set(self, path, size):
-        self.font = ImageFont.truetype(path, size)
+        self.font = font_get(path, size)
         self.font_ = [path, size]
 
     def size_set(self, size):
@@ -323,11 +860,32 @@ class Text(Shape):
     def render(self, draw, position):
         position = get_point(position)
         position = [position.x + self.position.x, position.y + self.position.y]
-        draw.multiline_text(self.corners_get(position)[0],
-                            text=self.text,
-                            font=self.font,
-                            fill=self.color_get(),
-                            align={"c": "center", "s": "left", "e": "right"}[self.align[0]])
+        corner = self.corners_get(position)[0]
+        align = self.aligns[self.align[0]]
+        # PIL rounds negative coordinates towards zero, so only the bitmaps of text at positive ones can be reused
+        if corner[0] < 0 or corner[1] < 0 or draw.mode not in ("RGB", "RGBA", "L", "LA"):
+            draw.multiline_text(corner, text=self.text, font=self.font, fill=self.color_get(), align=align)
+            return
+        x, y = floor(corner[0]), floor(corner[1])
+        (dx, dy), mask = self.bitmap_get((corner[0] - x, corner[1] - y), align, draw.fontmode)
+        draw.bitmap((x + dx, y + dy), mask, fill=self.color_get())
+
+    def bitmap_get(self, offset, align, fontmode):
+        # returns (position, mask) of the text drawn at the subpixel offset, the mask is cropped to the ink
+        # glyphs are drawn into the mask at positive coordinates, where PIL places them as on the canvas,
+        # and the mask is drawn with the color, so the pixels are the same as of drawing the text
+        def create():
+            measure = ImageDraw.Draw(PImage.new("L", (1, 1)))
+            measure.fontmode = fontmode
+            box = measure.multiline_textbbox(offset, self.text, font=self.font, align=align)
+            x, y = min(floor(box[0]) - 2, 0), min(floor(box[1]) - 2, 0)
+            mask = PImage.new("L", (ceil(box[2]) - x + 3, ceil(box[3]) - y + 3))
+            draw = ImageDraw.Draw(mask)
+            draw.fontmode = fontmode
+            draw.multiline_text((offset[0] - x, offset[1] - y), text=self.text, font=self.font, fill=255, align=align)
+            ink = mask.getbbox() or (0, 0, 0, 0)
+            return (x + ink[0], y + ink[1]), mask.crop(ink)
+        return self.bitmaps.get((self.text, self.font, align, fontmode, offset), create)
 
     def corners_get(self, position=(0, 0)):
         size = self.box_get()
@@ -342,10 +900,33 @@ class Text(Shape):
         return [corner, [corner[0] + size[0], corner[1] + size[1]]]
 
     def box_get(self):
-        return self.font.getsize_multiline(self.text)
+        return self.sizes.get((self.text, self.font), lambda: self.font.getsize_multiline(self.text))
+
+    def ink_get(self):
+        # box of the pixels of the text drawn at (0, 0), descenders and overhangs included
+        align = self.aligns[self.align[0]]
+
+        def create():
+            return ImageDraw.Draw(PImage.new("L", (1, 1))).multiline_textbbox((0, 0), self.text, font=self.font,
+                                                                             align=align)
+        return self.sizes.get((self.text, self.font, align), create)
+
+    def bounds_get(self, position):
+        corner = self.corners_get([position.x + self.position.x, position.y + self.position.y])[0]
+        ink = self.ink_get()
+        return make_bounds(corner[0] + ink[0], corner[1] + ink[1], corner[0] + ink[2], corner[1] + ink[3], pad=2)
 
     def resized(self, k):
-        return Text(self.text, self.font_[0], int(self.font_[1] * k), self.position, self.align, self.color)
+        return Text(self.text, self.font_[0], max(int(self.font_[1] * k), 1), self.position, self.align, self.color)
+
+    def preview_get(self, k):
+        # laid out and rasterized once, previews draw the text as a mask
+        text = self.resized(k)
+        size = text.box_get()
+        mask = PImage.new("L", (size[0] + 4, size[1] + 4))
+        ImageDraw.Draw(mask).multiline_text((2, 2), text=text.text, font=text.font, fill=255,
+                                            align=self.aligns[self.align[0]])
+        return MaskShape(mask, self.color)
 
 
 # mask, color[, position, size]
@@ -362,9 +943,9 @@ class MaskShape(Shape):
     def render(self, draw, position):
         position = get_point(position)
         position = [position.x + self.position.x, position.y + self.position.y]
-        mask = self.mask_get()
+        mask = self.mask.derived_get("L")
         if self.size is not None and mask.size != self.size:
-            mask = mask_resize(self, mask)
+            mask = mask_resize(self, mask, key=self.mask.key_get())
         draw.bitmap(position, mask, fill=self.color_get())
 
     def mask_set(self, mask):
@@ -376,6 +957,18 @@ class MaskShape(Shape):
     def box_get(self):
         return Utils.default(self.size, self.mask.size)
 
+    def bounds_get(self, position):
+        x, y = position.x + self.position.x, position.y + self.position.y
+        size = self.box_get()
+        return make_bounds(x, y, x + size[0], y + size[1])
+
+    def version_get(self):
+        return max(super().version_get(), self.mask.version_get())
+
+    def sources_get(self):
+        mask = self.mask.sources_get()
+        return None if mask is None else self.sources_own() + mask
+
     def __str__(self):
         size = Utils.default(self.size, self.mask.size)
         return "soda.MaskShape(in ({}, {}) with {}x{} size)".format(self.position.x,
@@ -388,10 +981,19 @@ class MaskShape(Shape):
             size = self.mask.size
         return MaskShape(self.mask, self.color, self.position, (size[0] * k, size[1] * k))
 
+    def preview_get(self, k):
+        # the mask is resampled once, bilinear
+        size = self.box_get()
+        size = (max(round(size[0] * k), 1), max(round(size[1] * k), 1))
+        mask = mask_resize(size, self.mask.derived_get("L"), PImage.BILINEAR, self.mask.key_get())
+        return MaskShape(mask, self.color, (round(self.position.x * k), round(self.position.y * k)))
+
 
 # image[, position, size, mask]
 class SodaImage(Shape):
     draw_type = "image"
+    _key = None
+
     def __init__(self, image, position=(0, 0), size=None, mask=None):
         self.mask = SodaImage(mask) if mask is not None else None
         self.size = tuple(size) if size is not None else None
@@ -399,7 +1001,34 @@ class SodaImage(Shape):
         self.position = get_point(position)
 
     def get(self, mode=None, orig=False):
-        image = self.image.render() if isinstance(self.image, Canvas) else self.image.copy()
+        return self.derived_get(mode, orig).copy()
+
+    def derived_get(self, mode=None, orig=False):
+        # returns the cropped/converted image, cached until set() is called; it's shared, so don't modify it
+        key = (None if orig else self.size, mode, self.source_get())
+        if key not in self._derived:
+            if len(self._derived) > 8:
+                self._derived.clear()
+            image = self.image.image_get() if isinstance(self.image, Canvas) else self.image
+            self._derived[key] = self.derive(image, mode, orig)
+        return self._derived[key]
+
+    def source_get(self):
+        # a number that changes whenever the source image does, unique among all images
+        return self.image.version_get() if isinstance(self.image, Canvas) else self._source
+
+    def key_get(self):
+        # identifies the pixels of derived_get() in shared caches: images with the same pixels get the same key,
+        # the digest is computed once per source; canvases are identified by their version
+        source = self.source_get()
+        if isinstance(self.image, Canvas):
+            return source, self.size
+        if self._key is None or self._key[0] != (source, self.size):
+            image = self.derived_get()
+            self._key = (source, self.size), (hashlib.sha1(image.tobytes()).hexdigest(), image.mode, image.size)
+        return self._key[1]
+
+    def derive(self, image, mode, orig):
         if image.size != self.size and not orig:
             image = self.crop(self.size, image)
         if mode is None or mode == image.mode:
@@ -407,6 +1036,8 @@ class SodaImage(Shape):
         return image.convert(mode)
 
     def set(self, image):
+        self._source = tick()
+        self._derived = {}
         its = lambda x: isinstance(image, x)
         if its(SodaImage):
             self.image = image.image
@@ -427,25 +1058,39 @@ class SodaImage(Shape):
             self.size = self.image.size
         self.size = tuple(self.size)
 
-    def resized(self, k, image=None, fitbox=True):
-        image = image or self.get()
-        res = image.resize(tuple(int(image.size[i] * k) for i in range(2)), resample=PImage.LANCZOS)
+    def resized(self, k, image=None, fitbox=True, resample=PImage.LANCZOS):
+        image = image or self.derived_get()
+        res = image.resize(tuple(int(image.size[i] * k) for i in range(2)), resample=resample)
         if fitbox:
             return SodaImage(res)
         return res
 
+    def preview_get(self, k):
+        # bilinear resampling, a nested canvas of the same size is rendered at the scale instead
+        size = (max(round(self.size[0] * k), 1), max(round(self.size[1] * k), 1))
+        if isinstance(self.image, Canvas) and tuple(self.image.size) == self.size:
+            image = self.image.render(scale=k)
+        else:
+            image = self.derived_get()
+        if image.size != size:
+            image = image.resize(size, PImage.BILINEAR, reducing_gap=2)
+        mask = None
+        if self.mask is not None:
+            mask = mask_resize(size, self.mask.derived_get("L"), PImage.BILINEAR, self.mask.key_get())
+        return SodaImage(image, (round(self.position.x * k), round(self.position.y * k)), mask=mask)
+
     def render(self, draw, position):
         if self.mask is not None:
-            mask = self.mask.get("L")
+            mask = self.mask.derived_get("L")
             if mask.size != self.image.size:
-                mask = mask_resize(self.image, mask)
+                mask = mask_resize(self.image, mask, key=self.mask.key_get())
         else:
             mask = None
         position = tuple([position.x + self.position.x, position.y + self.position.y])
-        draw.paste(self.get(), position, mask=mask)
+        draw.paste(self.derived_get(), position, mask=mask)
 
     def crop(self, size, image=None):
-        image = image or self.get(orig=True)
+        image = image or self.derived_get(orig=True)
         if type(size) == int:
             size = (size, size)
         k = fit(image.size, size)
@@ -457,8 +1102,22 @@ class SodaImage(Shape):
         return self.crop(Utils.default(size, min(self.size)))
 
     def box_get(self):
-        return self.get().size
-        
+        return self.size
+
+    def bounds_get(self, position):
+        x, y = position.x + self.position.x, position.y + self.position.y
+        return make_bounds(x, y, x + self.size[0], y + self.size[1])
+
+    def version_get(self):
+        return max(super().version_get(), latest_version(self.mask, self.image))
+
+    def sources_get(self):
+        # nested canvases are checked by their versions
+        mask = [] if self.mask is None else self.mask.sources_get()
+        if mask is None or isinstance(self.image, Canvas):
+            return None
+        return self.sources_own() + mask
+
 
 # o_class, arg_names, **params
 class Template:
@@ -470,8 +1129,8 @@ class Template:
     def create(self, *args, **params):
         for arg_i in range(len(self.arg_names)):
             key = self.arg_names[arg_i]
-            value = args[arg_i]
             if arg_i in range(len(args)):
+                value = args[arg_i]
                 if key not in params:
                     params[key] = value
             else:
@@ -481,13 +1140,75 @@ class Template:
     def __call__(self, *args, **params):
         return self.create(*args, **params)
 
+    def create_row(self, row):
+        # a row is a dict of params, a list (tuple) of args or a single arg
+        if isinstance(row, dict):
+            return self.create(**row)
+        return self.create(*row) if isinstance(row, (tuple, list)) else self.create(row)
+
+    def render_many(self, rows, canvas_factory, output, extension="png", workers=None, threads=False,
+                    ordered=True, window=None, report=None, **params):
+        # creates an object for every row, canvas_factory(obj, row) puts it on a Canvas (or returns a PIL image)
+        # images are rendered and encoded in a pool and passed to output as they are ready, in order of rows
+        # output is a callable(index, data) or a file name pattern: "badge-{0}.png" or "{name}.png" for dict rows
+        # at most window rows are in flight, rows are read from the iterable only when there is room for them
+        # report(stats) is called after every image, stats are returned: images, bytes, seconds, per_second
+        executor = executor_make(workers, threads)
+        window = Utils.default(window, executor._max_workers * 2)
+        stats = {"images": 0, "bytes": 0, "seconds": 0, "per_second": 0}
+        start = time.perf_counter()
+
+        def done(index, row, data):
+            if callable(output):
+                output(index, data)
+            else:
+                name = output.format(index, **row) if isinstance(row, dict) else output.format(index)
+                with open(name, "wb") as file:
+                    file.write(data)
+            stats["images"] += 1
+            stats["bytes"] += len(data)
+            stats["seconds"] = time.perf_counter() - start
+            stats["per_second"] = stats["images"] / stats["seconds"] if stats["seconds"] else 0
+            if report is not None:
+                report(dict(stats))
+
+        pending = {}
+        try:
+            for index, row in enumerate(rows):
+                future = executor.submit(template_render, self, canvas_factory, row, extension, params)
+                pending[future] = index, row
+                while len(pending) >= window:
+                    if ordered:
+                        future = next(iter(pending))
+                        done(*pending.pop(future), future.result())
+                        continue
+                    for future in wait(pending, return_when=FIRST_COMPLETED)[0]:
+                        done(*pending.pop(future), future.result())
+            while pending:
+                future = next(iter(pending)) if ordered else next(iter(wait(pending, return_when=FIRST_COMPLETED)[0]))
+                done(*pending.pop(future), future.result())
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+        return stats
+
+
+def template_render(template, canvas_factory, row, extension, params):
+    # runs in a pool of Template.render_many, returns the encoded image
+    image = canvas_factory(template.create_row(row), row)
+    if isinstance(image, Canvas):
+        image = image.render()
+    bio = io.BytesIO()
+    image.save(bio, extension, **params)
+    return bio.getvalue()
+
 
 # width[, height, color, position]
 class Rectangle(Polygon):
     def __init__(self, width, height=None, color=(0, 0, 0, 255), position=(0, 0)):
         height = Utils.default(height, width)
-        points = [Point(position[0] + width * (i in [1, 2]),
-                    position[1] + height * (i > 1)) for i in range(4)]
+        points = [(position[0] + width * (i in [1, 2]), position[1] + height * (i > 1)) for i in range(4)]
         super().__init__(points, color)
 
     def size_set(self, width, height=None):
@@ -498,9 +1219,207 @@ class Rectangle(Polygon):
         return super().__str__().replace("Polygon", "Rectangle")
 
 
+# boxes[, colors]
+class ShapeBatch(Shape):
+    # many homogeneous shapes drawn in one pass, boxes are (x, y, width, height) of instances, colors are one color or one per instance
+    # stamped batches (RectangleBatch, EllipseBatch) place the pixels of their instances into one array of labels with numpy
+    # and fill the image from it at once, the others draw them one by one, the result is the same as of separate shapes
+    draw_type = "image"
+    stamped = False
+    _layout = None
+    footprints = LRUCache(16 << 20, weigh=lambda footprint: footprint.size + 1)
+
+    def __init__(self, boxes, colors=(0, 0, 0, 255)):
+        self.boxes = boxes
+        self.colors = colors
+
+    def __setattr__(self, attr, value):
+        if attr == "boxes":
+            value = [list(box) for box in value] if numpy is None else numpy.array(value, dtype=float).reshape(-1, 4)
+        elif attr == "colors":
+            value = self.colors_make(value)
+        super().__setattr__(attr, value)
+
+    def colors_make(self, colors):
+        if is_array(colors) and colors.ndim == 2:
+            return colors.astype(numpy.uint8)
+        if isinstance(colors, (str, Color)) or (len(colors) in (3, 4) and not isinstance(colors[0], (tuple, list, str, Color))):
+            colors = [colors] * len(self.boxes)
+        colors = [Color.parse(color) + (255,) * (4 - len(Color.parse(color))) for color in colors]
+        return colors if numpy is None else numpy.array(colors, dtype=numpy.uint8).reshape(-1, 4)
+
+    def instance_set(self, index, box=None, color=None):
+        if box is not None:
+            self.boxes[index][:] = box
+        if color is not None:
+            self.colors[index][:] = Color.parse(color) + (255,) * (4 - len(Color.parse(color)))
+        self.touch()
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def extremes_get(self):
+        if not len(self.boxes):
+            return 0, 0, 0, 0
+        if numpy is not None:
+            return tuple(self.boxes[:, :2].min(0).tolist() + (self.boxes[:, :2] + self.boxes[:, 2:]).max(0).tolist())
+        return (min(box[0] for box in self.boxes), min(box[1] for box in self.boxes),
+                max(box[0] + box[2] for box in self.boxes), max(box[1] + box[3] for box in self.boxes))
+
+    def box_get(self):
+        x0, y0, x1, y1 = self.extremes_get()
+        return x1 - x0, y1 - y0
+
+    def bounds_get(self, position):
+        x0, y0, x1, y1 = self.extremes_get()
+        return make_bounds(x0 + position.x, y0 + position.y, x1 + position.x, y1 + position.y)
+
+    def draw_one(self, draw, x, y, width, height, color):
+        # draws one instance the way the single shape does
+        pass
+
+    def resized(self, k):
+        batch = object.__new__(self.__class__)
+        ShapeBatch.__init__(batch, self.boxes * k if is_array(self.boxes) else
+                            [[value * k for value in box] for box in self.boxes], self.colors)
+        return batch
+
+    def render(self, image, position):
+        if not self.stamp(image, position):
+            # numpy rows are turned into lists at once, numpy scalars are slow one by one
+            draw = ImageDraw.Draw(image)
+            boxes = self.boxes.tolist() if is_array(self.boxes) else self.boxes
+            colors = self.colors.tolist() if is_array(self.colors) else self.colors
+            for box, color in zip(boxes, colors):
+                self.draw_one(draw, box[0] + position.x, box[1] + position.y, box[2], box[3], tuple(color))
+
+    def footprint_get(self, width, height):
+        # (y, x) pixels of an instance drawn with draw_one in the (0, 0, width, height) box, PIL truncates coordinates
+        # to whole pixels before it rasterizes, so an instance covers these pixels moved to its truncated box
+        def create():
+            mask = PImage.new("L", (width + 3, height + 3))
+            self.draw_one(ImageDraw.Draw(mask), 1, 1, width, height, 255)
+            return numpy.argwhere(numpy.asarray(mask)) - 1
+
+        return ShapeBatch.footprints.get((type(self), width, height), create)
+
+    def stamp(self, image, position):
+        # the last layout is kept until the batch changes, moves or gets an image of another size
+        if not self.stamped or numpy is None or image.mode not in ("RGB", "RGBA") or not len(self.boxes):
+            return False
+        key = (self.version_get(), position.x, position.y, image.size)
+        if self._layout is None or self._layout[0] != key:
+            self._layout = key, self.layout_make(image.size, position)
+        layout = self._layout[1]
+        if layout is None:
+            return False
+        if layout:
+            # pixels are filled as 32-bit values, rgb images through rgba
+            box, fill, covered = layout
+            crop = image.crop(box)
+            pixels = numpy.array(crop if image.mode == "RGBA" else crop.convert("RGBA"))
+            numpy.copyto(pixels.view(numpy.uint32).ravel(), fill, where=covered)
+            image.paste(PImage.fromarray(pixels, "RGBA").convert(image.mode), box[:2])
+        return True
+
+    def layout_make(self, size, position):
+        # returns (box, fill, covered) of the part of a size image the batch covers: every pixel of the box is labeled
+        # with the last instance covering it, as drawing them in order would leave it, covered pixels get its color,
+        # () if nothing is visible, None if the instances should be drawn
+        boxes = self.boxes + (position.x, position.y, 0, 0)
+        if (boxes[:, 2:] < 0).any():
+            return None
+        corners = boxes
+        corners[:, 2:] += corners[:, :2]
+        whole = numpy.floor(corners)
+        # negative fractions are truncated toward zero, on band images where the canvas would truncate them
+        if ((corners < 0) & (corners != whole)).any():
+            return None
+        whole = whole.astype(numpy.int64)
+        sizes = whole[:, 2:] - whole[:, :2]
+        # instances are grouped by their size in whole pixels, usually there is one
+        keys = sizes[:, 0] * (sizes[:, 1].max() + 1) + sizes[:, 1]
+        if (keys == keys[0]).all():
+            groups = [(sizes[0].tolist(), numpy.arange(len(boxes), dtype=numpy.int32))]
+        else:
+            keys, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+            order = numpy.argsort(inverse, kind="stable").astype(numpy.int32)
+            groups = zip(sizes[first].tolist(), numpy.split(order, numpy.cumsum(numpy.bincount(inverse))[:-1]))
+        groups = [(self.footprint_get(w, h), indices) for (w, h), indices in groups]
+        # draw calls cost per instance, stamping costs per pixel of the instances, few large instances are drawn
+        if sum(len(footprint) * len(indices) for footprint, indices in groups) > len(boxes) * 256:
+            return None
+        # make_bounds of the corners, they are whole pixels or nonnegative (floor and int round them alike)
+        (x0, y0), (x1, y1) = (whole.min(0)[:2] - 1).tolist(), (whole.max(0)[2:] + 2).tolist()
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, size[0]), min(y1, size[1])
+        if x0 >= x1 or y0 >= y1:
+            return ()
+        width, height = x1 - x0, y1 - y0
+        # the labels cost per pixel of the covered part too, few instances far apart are drawn
+        if len(boxes) * 1000 < width * height:
+            return None
+        labels = numpy.full(width * height, -1, numpy.int32)
+        for footprint, indices in groups:
+            if not len(footprint):
+                continue
+            xs, ys = whole[indices, 0] - x0, whole[indices, 1] - y0
+            (top, left), (bottom, right) = footprint.min(0).tolist(), footprint.max(0).tolist()
+            clipped = (xs + left < 0) | (ys + top < 0) | (xs + right >= width) | (ys + bottom >= height)
+            offsets = footprint[:, 0] * width + footprint[:, 1]
+            # instances of a size are placed in parts of about a million pixels, the ones cut by the edges of
+            # the image pixel by pixel
+            step = max((1 << 20) // len(footprint), 1)
+            for start in range(0, len(indices), step):
+                part = slice(start, start + step)
+                flat = ((ys[part] * width + xs[part])[:, None] + offsets).ravel()
+                values = numpy.repeat(indices[part], len(footprint))
+                if clipped[part].any():
+                    y = (ys[part, None] + footprint[:, 0]).ravel()
+                    x = (xs[part, None] + footprint[:, 1]).ravel()
+                    inside = (y >= 0) & (y < height) & (x >= 0) & (x < width)
+                    flat, values = flat[inside], values[inside]
+                numpy.maximum.at(labels, flat, values)
+        colors = numpy.ascontiguousarray(self.colors).view(numpy.uint32).ravel()
+        return (x0, y0, x1, y1), colors.take(labels), labels >= 0
+
+
+# positions, sizes[, colors]
+class RectangleBatch(ShapeBatch):
+    # renders like Rectangle(width, height, color, position) for every instance
+    stamped = True
+
+    def __init__(self, positions, sizes, colors=(0, 0, 0, 255)):
+        if type(sizes) in (int, float):
+            sizes = (sizes, sizes)
+        if len(sizes) == 2 and type(sizes[0]) in (int, float):
+            sizes = [sizes] * len(positions)
+        super().__init__([(p[0], p[1], s[0], s[1]) for p, s in zip(positions, sizes)], colors)
+
+    def draw_one(self, draw, x, y, width, height, color):
+        draw.polygon([x, y, x + width, y, x + width, y + height, x, y + height], fill=color)
+
+
+# centers, radii[, colors]
+class EllipseBatch(ShapeBatch):
+    # renders like Ellipse(center, x_radius, y_radius, color) for every instance
+    stamped = True
+
+    def __init__(self, centers, radii, colors=(0, 0, 0, 255)):
+        if type(radii) in (int, float):
+            radii = (radii, radii)
+        if len(radii) == 2 and type(radii[0]) in (int, float):
+            radii = [radii] * len(centers)
+        super().__init__([(c[0] - r[0], c[1] - r[1], r[0] * 2, r[1] * 2) for c, r in zip(centers, radii)], colors)
+
+    def draw_one(self, draw, x, y, width, height, color):
+        draw.ellipse([(x, y), (x + width, y + height)], fill=color)
+
+
 # shape, box[, position]
 class FitBox(Shape):
     def __init__(self, shape: Shape, box, position=Point(0, 0)):
+        self._fitted = None
+        self._hits = self._misses = 0
         self.debug = False
         self.initial = shape
         self.position = get_point(position)
@@ -525,25 +1444,626 @@ class FitBox(Shape):
         shape = self.shape_get()
         position = Point(position.x + self.position.x, position.y + self.position.y)
         if self.debug:
-            if type(self.initial) == Text:
-                shape.text = "{}x{}".format(*self.box)
             draw.rectangle(((position.x, position.y), (position.x + self.box[0], position.y + self.box[1])),
                            fill=self.color_get())
 
         shape.render(draw, position)
 
     def resized(self, k):
-        return FitBox(self.initial, tuple(self.box[i] // k for i in range(len(self.box))))
+        return FitBox(self.initial, tuple(value * k for value in self.box), self.position)
+
+    def preview_get(self, k):
+        # the wrapped shape is resized once, straight to the preview scale
+        return self.initial.preview_get(fit(self.box, self.initial.box_get()) * k)
 
     def shape_get(self):
-        return self.initial.resized(fit(self.box, self.initial.box_get()))
+        # the fitted shape is cached until the box, the wrapped shape or debug changes
+        # with debug a fitted text shows the size of the box, the wrapped text stays as it is
+        key = (tuple(self.box), self.initial, self.initial.version_get(), self.debug)
+        if self._fitted is not None and self._fitted[0] == key:
+            self._hits += 1
+        else:
+            self._misses += 1
+            shape = self.initial.resized(fit(self.box, self.initial.box_get()))
+            if self.debug and type(self.initial) == Text:
+                shape.text = "{}x{}".format(*self.box)
+            self._fitted = key, shape
+        return self._fitted[1]
+
+    def cache_info(self):
+        return {"hits": self._hits, "misses": self._misses}
+
+    def bounds_get(self, position):
+        position = Point(position.x + self.position.x, position.y + self.position.y)
+        bounds = self.shape_get().bounds_get(position)
+        if bounds is not None and self.debug:
+            bounds = bounds_union(bounds, make_bounds(position.x, position.y,
+                                                      position.x + self.box[0], position.y + self.box[1]))
+        return bounds
+
+    def version_get(self):
+        return max(super().version_get(), self.initial.version_get())
+
+    def sources_get(self):
+        initial = self.initial.sources_get()
+        return None if initial is None else self.sources_own() + initial
 
     def box_get(self):
-        return box
+        return self.box
+
+
+# [entries]
+class ObjectList:
+    # z-ordered canvas entries with unique labels
+    # entries are kept in chunks, so insert, remove and reorder don't shift the whole list
+    # the list watches the objects of its entries, their colors and positions (see Shape.sources_get):
+    # entries whose sources change are noted in every journal, {id(entry): entry} dicts of the readers
+    # (the spatial grid, the canvas), so readers go through what changed instead of all entries
+    # entries of shapes that can't list their sources are volatile, readers check their versions
+    # entries put by extend are watched once a reader settles the list, before it goes through its journal
+    load = 512
+
+    def __init__(self, entries=()):
+        self.chunks = []
+        self.labels = {}
+        self.where = {}
+        self.length = 0
+        self.counter = 0
+        # revision changes with every entry put or removed, and with moves made through Canvas.move,
+        # order only with entries put or removed
+        self.revision = 0
+        self.order = 0
+        self.grid = None
+        self.ref = weakref.ref(self)
+        self.sources = {}
+        self.watched = {}
+        self.volatile = {}
+        self.unwatched = {}
+        self.journals = []
+        self.extend(entries)
+
+    def label_make(self):
+        self.counter += 1
+        while "obj{}".format(self.counter) in self.labels:
+            self.counter += 1
+        return "obj{}".format(self.counter)
+
+    def register(self, entry, chunk):
+        if entry.get("label") is None:
+            entry["label"] = self.label_make()
+        elif entry["label"] in self.labels:
+            raise ValueError("label {} is already used on the canvas".format(entry["label"]))
+        self.labels[entry["label"]] = entry
+        self.where[entry["label"]] = chunk
+        self.length += 1
+        self.revision += 1
+        self.order += 1
+        self.watch(entry)
+        self.note(entry)
+        if self.grid is not None:
+            self.grid.add(entry)
+
+    def watch(self, entry):
+        self.watch_all((entry,))
+
+    def watch_all(self, entries, set_=object.__setattr__):
+        # sources of an entry are kept in a tuple, entries of a source in a tuple of one or in {id(entry): entry}
+        watched, volatile, sources_kept, ref = self.watched, self.volatile, self.sources, self.ref
+        for entry in entries:
+            sources = entry["object"].sources_get()
+            if sources is None:
+                volatile[id(entry)] = entry
+                sources = []
+            sources.append(entry["position"])
+            kept = []
+            for source in sources:
+                key = id(source)
+                watchers = watched.get(key)
+                if watchers is None:
+                    watched[key] = (entry,)
+                    if source._watchers is None:
+                        set_(source, "_watchers", ref)
+                    else:
+                        self.watcher_add(source)
+                elif type(watchers) is tuple:
+                    if watchers[0] is entry:
+                        continue
+                    watched[key] = {id(watchers[0]): watchers[0], id(entry): entry}
+                elif id(entry) in watchers:
+                    continue
+                else:
+                    watchers[id(entry)] = entry
+                kept.append(source)
+            sources_kept[id(entry)] = tuple(kept)
+
+    def watcher_add(self, source):
+        watchers = source._watchers
+        if watchers is None or type(watchers) is weakref.ref and watchers() is None:
+            object.__setattr__(source, "_watchers", self.ref)
+        elif type(watchers) is weakref.ref:
+            object.__setattr__(source, "_watchers", {id(watchers()): watchers, id(self): self.ref})
+        else:
+            watchers[id(self)] = self.ref
+
+    def settle(self):
+        # watches the entries put by extend, the changes made before are covered by their notes in the journals
+        if self.unwatched:
+            unwatched, self.unwatched = self.unwatched, {}
+            self.watch_all(unwatched.values())
+
+    def unwatch(self, entry):
+        if self.unwatched.pop(id(entry), None) is not None:
+            return
+        self.volatile.pop(id(entry), None)
+        for source in self.sources.pop(id(entry)):
+            entries = self.watched[id(source)]
+            if type(entries) is tuple:
+                del self.watched[id(source)]
+                if source._watchers is self.ref:
+                    object.__setattr__(source, "_watchers", None)
+                else:
+                    source._watchers.pop(id(self), None)
+            else:
+                del entries[id(entry)]
+                if len(entries) == 1:
+                    self.watched[id(source)] = tuple(entries.values())
+
+    def note(self, entry):
+        for journal in self.journals:
+            journal[id(entry)] = entry
+
+    def source_changed(self, source):
+        entries = self.watched.get(id(source))
+        if entries is None:
+            return
+        for entry in list(entries if type(entries) is tuple else entries.values()):
+            # a changed shape may have got another color or position
+            if entry["object"] is source:
+                self.unwatch(entry)
+                self.watch(entry)
+            self.note(entry)
+
+    def moved(self, entry):
+        # called after the position of the entry is replaced
+        self.revision += 1
+        if id(entry) not in self.unwatched:
+            self.unwatch(entry)
+            self.watch(entry)
+        self.note(entry)
+        if self.grid is not None:
+            self.grid.update(entry)
+
+    def locate(self, index):
+        # returns (chunk, index in chunk) of the index-th entry
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("canvas object index out of range")
+        for chunk in self.chunks:
+            if index < len(chunk):
+                return chunk, index
+            index -= len(chunk)
+
+    @staticmethod
+    def find(items, item):
+        return list(map(is_, items, repeat(item))).index(True)
+
+    def insert(self, index, entry):
+        if index < 0:
+            index = max(self.length + index, 0)
+        if not self.chunks:
+            self.chunks.append([])
+        if index >= self.length:
+            chunk, index = self.chunks[-1], len(self.chunks[-1])
+        else:
+            chunk, index = self.locate(index)
+        self.register(entry, chunk)
+        chunk.insert(index, entry)
+        if len(chunk) > self.load * 2:
+            half = chunk[self.load:]
+            del chunk[self.load:]
+            self.chunks.insert(self.find(self.chunks, chunk) + 1, half)
+            for item in half:
+                self.where[item["label"]] = half
+
+    def append(self, entry):
+        self.insert(self.length, entry)
+
+    def extend(self, entries):
+        # appends entries like append() one by one would, but labels, chunks and journals are done in one pass
+        # each and watchers are attached when the list is settled (loaded scenes put thousands of entries at once)
+        # no entry is put if a label is taken
+        entries = list(entries)
+        labels, added = self.labels, []
+        try:
+            for entry in entries:
+                if entry.get("label") is None:
+                    entry["label"] = self.label_make()
+                elif entry["label"] in labels:
+                    raise ValueError("label {} is already used on the canvas".format(entry["label"]))
+                labels[entry["label"]] = entry
+                added.append(entry["label"])
+        except ValueError:
+            for label in added:
+                del labels[label]
+            raise
+        start = 0
+        if self.chunks and len(self.chunks[-1]) < self.load:
+            start = self.load - len(self.chunks[-1])
+            self.chunks[-1].extend(entries[:start])
+            self.where.update(zip(added[:start], repeat(self.chunks[-1])))
+        for i in range(start, len(entries), self.load):
+            chunk = entries[i:i + self.load]
+            self.chunks.append(chunk)
+            self.where.update(zip(added[i:i + self.load], repeat(chunk)))
+        self.length += len(entries)
+        self.revision += len(entries)
+        self.order += len(entries)
+        noted = {id(entry): entry for entry in entries}
+        self.unwatched.update(noted)
+        for journal in self.journals:
+            journal.update(noted)
+        if self.grid is not None:
+            for entry in entries:
+                self.grid.add(entry)
+
+    def remove(self, entry):
+        chunk = self.where.pop(entry["label"])
+        del self.labels[entry["label"]]
+        del chunk[self.find(chunk, entry)]
+        if not chunk:
+            del self.chunks[self.find(self.chunks, chunk)]
+        self.length -= 1
+        self.revision += 1
+        self.order += 1
+        self.unwatch(entry)
+        for journal in self.journals:
+            journal.pop(id(entry), None)
+        if self.grid is not None:
+            self.grid.discard(entry)
+
+    def pop(self, key=-1):
+        entry = self.get(key)
+        self.remove(entry)
+        return entry
+
+    def get(self, key):
+        # key is an index or a label
+        if isinstance(key, str):
+            return self.labels[key]
+        chunk, index = self.locate(key)
+        return chunk[index]
+
+    def ordered(self, found):
+        # returns the {id(entry): entry} entries in list order, only chunks that hold some of them are scanned
+        chunks = {id(self.where[entry["label"]]) for entry in found.values()}
+        return [entry for chunk in self.chunks if id(chunk) in chunks for entry in chunk if id(entry) in found]
+
+    def index(self, entry):
+        chunk = self.where[entry["label"]]
+        position = self.find(self.chunks, chunk)
+        return sum(len(item) for item in self.chunks[:position]) + self.find(chunk, entry)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(self)[key]
+        return self.get(key)
+
+    def __setitem__(self, index, entry):
+        index = index + self.length if index < 0 else index
+        self.remove(self.get(index))
+        self.insert(index, entry)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, entry):
+        return self.labels.get(entry.get("label")) is entry
+
+    def __iter__(self):
+        return chain.from_iterable(self.chunks)
+
+    def __len__(self):
+        return self.length
+
+
+class SpatialGrid:
+    # uniform grid of canvas entries by their world-space boxes (see Shape.bounds_get)
+    # shapes and positions changed in place are re-indexed on the next query after the change,
+    # they are taken from the journal of the object list, so a query costs as much as what changed
+    cell = 64
+    spread = 256
+
+    def __init__(self, entries=()):
+        # the grid is built from entries on the first query
+        self.entries = entries
+        self.built = False
+        self.cells = {}
+        self.records = {}
+        self.wide = {}
+        self.changed = {}
+        if isinstance(entries, ObjectList):
+            entries.journals.append(self.changed)
+
+    def keys_get(self, bounds):
+        x0, y0 = bounds[0] // self.cell, bounds[1] // self.cell
+        x1, y1 = (bounds[2] - 1) // self.cell, (bounds[3] - 1) // self.cell
+        return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+    def add(self, entry):
+        if self.built:
+            self.insert(entry)
+
+    def insert(self, entry):
+        obj, position = entry["object"], entry["position"]
+        bounds = obj.bounds_get(position)
+        keys = None
+        # objects with unknown boxes or spread over too many cells are checked on every query
+        if bounds is not None and (bounds[2] - bounds[0]) * (bounds[3] - bounds[1]) <= self.spread * self.cell ** 2:
+            keys = self.keys_get(bounds)
+            for key in keys:
+                self.cells.setdefault(key, {})[id(entry)] = entry
+        else:
+            self.wide[id(entry)] = entry
+        self.records[id(entry)] = (entry, obj, obj.version_get(), (position.x, position.y), bounds, keys)
+
+    def update(self, entry):
+        if self.built:
+            self.discard(entry)
+            self.insert(entry)
+            self.changed.pop(id(entry), None)
+
+    def discard(self, entry):
+        record = self.records.pop(id(entry), None)
+        if record is None:
+            return
+        if record[5] is None:
+            del self.wide[id(entry)]
+            return
+        for key in record[5]:
+            cell = self.cells[key]
+            del cell[id(entry)]
+            if not cell:
+                del self.cells[key]
+
+    def refresh(self, limit=None):
+        # returns False without re-indexing if more than limit entries changed
+        if isinstance(self.entries, ObjectList):
+            self.entries.settle()
+        if not self.built:
+            self.built = True
+            self.changed.clear()
+            for entry in self.entries:
+                self.insert(entry)
+            return True
+        if limit is not None and len(self.changed) > limit:
+            return False
+        changed = list(self.changed.values())
+        for entry in getattr(self.entries, "volatile", {}).values():
+            record = self.records.get(id(entry))
+            obj, position = entry["object"], entry["position"]
+            if record is None or record[1] is not obj or record[3] != (position.x, position.y) or \
+                    record[2] != obj.version_get():
+                changed.append(entry)
+        if limit is not None and len(changed) > limit:
+            return False
+        for entry in changed:
+            self.discard(entry)
+            self.insert(entry)
+        self.changed.clear()
+        return True
+
+    def query(self, bounds, limit=None):
+        # returns {id(entry): entry} of entries whose boxes intersect (x0, y0, x1, y1) bounds
+        # returns None if more than limit entries have to be re-indexed first
+        if not self.refresh(limit):
+            return None
+        found = {}
+        records = self.records
+        keys = self.keys_get(bounds)
+        if len(keys) > len(self.cells):
+            keys = [key for key in self.cells if bounds[0] // self.cell <= key[0] <= (bounds[2] - 1) // self.cell and
+                    bounds[1] // self.cell <= key[1] <= (bounds[3] - 1) // self.cell]
+        for key in keys:
+            for key_, entry in self.cells.get(key, {}).items():
+                if key_ not in found and bounds_intersect(records[key_][4], bounds):
+                    found[key_] = entry
+        for key_, entry in self.wide.items():
+            if records[key_][4] is None or bounds_intersect(records[key_][4], bounds):
+                found[key_] = entry
+        return found
+
+
+def caches_info():
+    # returns cache_info() of the shared caches by name
+    return {"fonts": fonts.cache_info(), "colors": colors.cache_info(), "masks": masks.cache_info(),
+            "roundrect masks": RoundRect.masks.cache_info(), "text bitmaps": Text.bitmaps.cache_info(),
+            "text sizes": Text.sizes.cache_info(),
+            "batch footprints": ShapeBatch.footprints.cache_info()}
+
+
+# [before, after]
+class Profiler:
+    # opt-in instrumentation of Canvas.render: Canvas(profiler=Profiler()) or canvas.profiler = Profiler()
+    # before(entry) and after(entry, seconds) callbacks are called around every object render
+    # canvases nested with SodaImage are profiled as a part of their parent if they share the profiler
+    def __init__(self, before=None, after=None):
+        self.before = [] if before is None else [before]
+        self.after = [] if after is None else [after]
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.time = 0
+        self.classes = {}
+        self.labels = {}
+        self.folded = {}
+        self.caches = {}
+        self.stack = []
+        self.children = []
+        self.started = 0
+        self.snapshot = None
+
+    def frame_start(self, canvas):
+        if self.stack:
+            return
+        self.started = time.perf_counter()
+        self.snapshot = caches_info()
+
+    def frame_end(self, canvas):
+        if self.stack:
+            return
+        self.frames += 1
+        self.time += time.perf_counter() - self.started
+        for name, info in caches_info().items():
+            total = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+            total["hits"] += info["hits"] - self.snapshot[name]["hits"]
+            total["misses"] += info["misses"] - self.snapshot[name]["misses"]
+
+    @staticmethod
+    def record(stats, key, seconds, hits, misses):
+        record = stats.get(key)
+        if record is None:
+            record = stats[key] = {"count": 0, "time": 0, "max": 0, "cache hits": 0, "cache misses": 0}
+        record["count"] += 1
+        record["time"] += seconds
+        record["max"] = max(record["max"], seconds)
+        record["cache hits"] += hits
+        record["cache misses"] += misses
+
+    def render(self, entry, target, position):
+        obj = entry["object"]
+        for callback in self.before:
+            callback(entry)
+        name = "{}:{}".format(obj.__class__.__name__, Utils.default(entry.get("label"), "background"))
+        info = obj.cache_info() if hasattr(obj, "cache_info") else None
+        self.stack.append(name)
+        self.children.append(0)
+        start = time.perf_counter()
+        try:
+            obj.render(target, position)
+        finally:
+            seconds = time.perf_counter() - start
+            children = self.children.pop()
+            stack = ";".join(self.stack)
+            self.stack.pop()
+        if self.children:
+            self.children[-1] += seconds
+        self.folded[stack] = self.folded.get(stack, 0) + seconds - children
+        hits = misses = 0
+        if info is not None:
+            after = obj.cache_info()
+            hits, misses = after["hits"] - info["hits"], after["misses"] - info["misses"]
+        self.record(self.classes, obj.__class__.__name__, seconds, hits, misses)
+        self.record(self.labels, Utils.default(entry.get("label"), "background"), seconds, hits, misses)
+        for callback in self.after:
+            callback(entry, seconds)
+
+    def stats(self):
+        # returns {"frames", "time", "classes", "labels", "caches"}, times are in seconds
+        return {"frames": self.frames, "time": self.time,
+                "classes": {key: dict(value) for key, value in self.classes.items()},
+                "labels": {key: dict(value) for key, value in self.labels.items()},
+                "caches": {key: dict(value) for key, value in self.caches.items()}}
+
+    def flame(self, file=None):
+        # returns the folded stacks ("canvas;Class:label;... microseconds" lines) flamegraph.pl and speedscope read
+        lines = ["canvas;{} {}".format(key, round(value * 1e6)) for key, value in sorted(self.folded.items())]
+        text = "\n".join(lines) + "\n"
+        if file is not None:
+            if isinstance(file, str):
+                with open(file, "w") as f:
+                    f.write(text)
+            else:
+                file.write(text)
+        return text
+
+
+class TranslatedDraw:
+    # the core draw of a band image that takes canvas coordinates: PIL truncates coordinates to whole pixels
+    # before it rasterizes, so they are truncated where the canvas would truncate them and then moved by the
+    # whole pixel origin of the band, the band gets the same pixels as the full render has there
+    # shift is added to the coordinates first, for draws of shapes that get band coordinates
+    def __init__(self, image, draw, origin, shift=(0, 0), mode=None):
+        self.image = image
+        self.draw = draw
+        self.origin = origin
+        self.shift = shift
+        self.mode = mode
+        self.scratch = None
+
+    @staticmethod
+    def create(image, origin, shift=(0, 0), mode=None):
+        draw = ImageDraw.ImageDraw(image, mode)
+        draw.draw = TranslatedDraw(image, draw.draw, origin, shift, mode)
+        return draw
+
+    def __getattr__(self, name):
+        return getattr(self.draw, name)
+
+    def xy(self, xy):
+        (x0, y0), (dx, dy) = self.origin, self.shift
+        flat = ImagePath.Path(xy).tolist(True)
+        flat[0::2] = [int(x + dx) - x0 for x in flat[0::2]]
+        flat[1::2] = [int(y + dy) - y0 for y in flat[1::2]]
+        return flat
+
+    def stepped(self, method, xy, *args, margin=2):
+        # polygon edges are stepped in floats from their x, so a polygon moved along x may round a pixel of an
+        # edge differently: right of the canvas origin the pixels around are copied to a scratch image that
+        # starts at the canvas x, the polygon is drawn there and the pixels are copied back
+        # vertical and horizontal edges aren't stepped, polygons made of them are drawn as they are
+        x0 = self.origin[0]
+        xs, ys = xy[0::2], xy[1::2]
+        if not x0 or not xy or all(x == xs[i - 1] or y == ys[i - 1] for i, (x, y) in enumerate(zip(xs, ys))):
+            return getattr(self.draw, method)(xy, *args)
+        width, height = self.image.size
+        box = (max(min(xs) - margin, 0), max(min(ys) - margin, 0),
+               min(max(xs) + margin + 1, width), min(max(ys) + margin + 1, height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+        if self.scratch is None:
+            self.scratch = ImageDraw.ImageDraw(PImage.new(self.image.mode, (x0 + width, height)), self.mode)
+        scratch = self.scratch.im
+        scratch.paste(self.image.im.crop(box), (box[0] + x0, box[1], box[2] + x0, box[3]))
+        xy[0::2] = [x + x0 for x in xy[0::2]]
+        getattr(self.scratch.draw, method)(xy, *args)
+        self.image.im.paste(scratch.crop((box[0] + x0, box[1], box[2] + x0, box[3])), box)
+
+    def draw_bitmap(self, xy, bitmap, ink):
+        return self.draw.draw_bitmap(tuple(self.xy(xy)), bitmap, ink)
+
+    def draw_points(self, xy, *args):
+        return self.draw.draw_points(self.xy(xy), *args)
+
+    def draw_lines(self, xy, ink, width=0):
+        # lines wider than a pixel are drawn as polygons
+        if width > 1:
+            return self.stepped("draw_lines", self.xy(xy), ink, width, margin=width + 2)
+        return self.draw.draw_lines(self.xy(xy), ink, width)
+
+    def draw_polygon(self, xy, *args):
+        return self.stepped("draw_polygon", self.xy(xy), *args)
+
+    def draw_rectangle(self, xy, *args):
+        return self.draw.draw_rectangle(self.xy(xy), *args)
+
+    def draw_ellipse(self, xy, *args):
+        return self.draw.draw_ellipse(self.xy(xy), *args)
+
+    def draw_arc(self, xy, *args):
+        return self.draw.draw_arc(self.xy(xy), *args)
+
+    def draw_chord(self, xy, *args):
+        return self.draw.draw_chord(self.xy(xy), *args)
+
+    def draw_pieslice(self, xy, *args):
+        return self.draw.draw_pieslice(self.xy(xy), *args)
 
 
 class Canvas:
-    def __init__(self, size=(1000, 1000), color="white", mode="RGBA", background=None):
+    def __init__(self, size=(1000, 1000), color="white", mode="RGBA", background=None, incremental=False,
+                 profiler=None):
         self.color = Color(color)
         self.objects = []
         self.mode = mode
@@ -551,38 +2071,453 @@ class Canvas:
             size = (size, size)
         self.size = size
         self.background = background
+        self.incremental = incremental
+        self.profiler = profiler
+        self.layers = []
+        self._frame = None
+        self._dirty = None
+        self._renders = 0
+        self._rendered = {}
+        self._order = []
+        self._reordered = []
+        self._state = None
+        self._list = None
+        self._sequence = None
+        self._scratch = None
+        self._previews = {}
+        self._preview_background = None
+        self._background = None
+        self._base = self._under = None
+        self._content = None
+        self._version = 0
+        self._image = None
+        self._image_version = None
+        self._busy = None
+
+    @property
+    def objects(self):
+        return self._objects
+
+    @objects.setter
+    def objects(self, entries):
+        if not isinstance(entries, ObjectList):
+            entries = ObjectList(entries)
+        entries.grid = SpatialGrid(entries)
+        self._objects = entries
+        # entries changed since the last version_get and since the last incremental render
+        self._changes = {}
+        self._pending = {}
+        self._content = None
+        entries.journals += [self._changes, self._pending]
 
     def put(self, obj: Shape, position=None, index=None, label=None):
+        # returns the label of the object, labels are unique on the canvas
         position = get_point(Utils.default(position, [0, 0]))
-        obj_ = {"object": obj, "position": position, "label": Utils.default(label, "obj{}".format(random.randint(1, 10000)))}
+        obj_ = {"object": obj, "position": position, "label": label}
         if index is None:
             self.objects.append(obj_)
         else:
             self.objects.insert(index, obj_)
+        return obj_["label"]
+
+    def get(self, key):
+        # returns the entry ({"object", "position", "label"}) with the chosen index or label
+        return self.objects.get(key)
+
+    def pop(self, key):
+        return self.objects.pop(key)
+
+    def move(self, key, position):
+        entry = self.objects.get(key)
+        entry["position"] = Point(*position)
+        self.objects.moved(entry)
+
+    def objects_in(self, bounds):
+        # returns entries whose boxes intersect (x0, y0, x1, y1) bounds, in z-order
+        found = self.objects.grid.query(tuple(floor(value) for value in bounds[:2]) +
+                                        tuple(ceil(value) for value in bounds[2:]))
+        return self.entries_sort(found)
+
+    def entries_sort(self, found):
+        # returns {id(entry): entry} entries in z-order
+        return self.objects.ordered(found)
+
+    def objects_at(self, point):
+        # returns entries whose boxes cover the pixel at the point, in z-order
+        x, y = (point.x, point.y) if isinstance(point, Point) else point
+        x, y = floor(x), floor(y)
+        return self.objects_in((x, y, x + 1, y + 1))
+
+    def reorder(self, key, index):
+        # moves the object to another place in z-order
+        entry = self.objects.pop(key)
+        self.objects.insert(index, entry)
+        if self._frame is not None:
+            self._reordered.append(id(entry))
+
+    def nesting_check(self):
+        # _busy is the thread that is rendering the canvas or collecting its version
+        if self._busy == threading.get_ident():
+            raise ValueError("canvas is nested in itself")
+
+    def state_get(self):
+        # everything but the objects a frame depends on, layers are in it by their versions
+        return (tuple(self.size), self.mode, self.color.color, id(self.background),
+                tuple(layer.key_get() for layer in self.layers))
+
+    def version_get(self):
+        # returns a number that changes whenever the canvas, its objects or canvases nested in them change
+        # objects are known to change from the journal of the object list, only volatile ones are asked
+        self.nesting_check()
+        self._busy = threading.get_ident()
+        try:
+            self.objects.settle()
+            volatile = self.objects.volatile
+            content = (self.state_get(), self.objects.revision,
+                       latest_version(*[entry["object"] for entry in volatile.values()]) if volatile else 0)
+        finally:
+            self._busy = None
+        if content != self._content or self._changes:
+            self._changes.clear()
+            self._content = content
+            self._version = tick()
+        return self._version
+
+    def dirty_get(self):
+        # returns (number of renders, boxes repainted by the last one): boxes are [] if the frame didn't change
+        # and None if it was rendered in full
+        return self._renders, self._dirty
+
+    def image_get(self):
+        # returns the last rendered image while nothing on the canvas changes; it's shared, so don't modify it
+        version = self.version_get()
+        if self._image is None or self._image_version != version:
+            self._image = self.render()
+            self._image_version = version
+        return self._image
+
+    def entries_get(self):
+        if self.background:
+            return [{"object": self.background_get(), "position": Point(0, 0)}] + list(self.objects)
+        return self.objects
+
+    def background_get(self):
+        # the background wrapped in a SodaImage, kept while the background is the same image
+        if self._background is None or self._background[0] is not self.background:
+            self._background = self.background, SodaImage(self.background)
+        return self._background[1]
+
+    def layer_add(self, name, static=False, index=None):
+        # adds a transparent layer, drawn over the background and the layers before it and under the objects
+        if self.layer_get(name) is not None:
+            raise ValueError("layer {!r} already exists".format(name))
+        size = tuple(self.background.size) if self.background is not None else tuple(self.size)
+        layer = Layer(size, static=static, name=name)
+        self.layers.insert(len(self.layers) if index is None else index, layer)
+        return layer
+
+    def layer_get(self, name):
+        return next((layer for layer in self.layers if layer.name == name), None)
+
+    def layer_remove(self, name):
+        layer = self.layer_get(name)
+        if layer is None:
+            raise KeyError(name)
+        self.layers.remove(layer)
+        return layer
 
-    def pop(self, index):
-        return self.objects.pop(index)
-
-    def move(self, index, position):
-        self.objects[index]["position"] = Point(*position)
-
-    def render(self):
-        if self.background is None:
+    @staticmethod
+    def composite(image, top):
+        # draws an RGBA image of a layer over the image
+        if image.mode == "RGBA":
+            image.alpha_composite(top)
+        else:
+            image.paste(top, (0, 0), top)
+
+    def under_get(self):
+        # returns the image of what is under the objects: the color, the background and the layers
+        # static layers at the bottom are flattened with the background into one image, kept until they change,
+        # other layers are composited over its copy when one of them changes; it's shared, so don't modify it
+        size = tuple(self.background.size) if self.background is not None else tuple(self.size)
+        for layer in self.layers:
+            if tuple(layer.size) != size:
+                layer.size = size
+        static = 0
+        while static < len(self.layers) and self.layers[static].static:
+            static += 1
+        key = (size, self.mode, self.color.color, id(self.background),
+               tuple(layer.key_get() for layer in self.layers[:static]))
+        if self._base is None or self._base[0] != key:
+            image = PImage.new(self.mode, size, self.color.color)
+            if self.background is not None:
+                self.background_get().render(image, Point(0, 0))
+            for layer in self.layers[:static]:
+                self.composite(image, layer.image_get())
+            self._base = key, image
+            self._under = None
+        key = tuple(layer.key_get() for layer in self.layers[static:])
+        if self._under is None or self._under[0] != key:
+            image = self._base[1]
+            if static < len(self.layers):
+                image = image.copy()
+                for layer in self.layers[static:]:
+                    self.composite(image, layer.image_get())
+            self._under = key, image
+        return self._under[1]
+
+    def render(self, incremental=None, scale=1):
+        # incremental render reuses the previous frame and repaints only the regions that changed since then
+        # the returned image is the same object on every incremental render, copy it to keep a frame
+        # with scale, a preview of the canvas that many times smaller (or bigger) is rendered, see render_scaled
+        incremental = Utils.default(incremental, self.incremental)
+        self.nesting_check()
+        self._busy = threading.get_ident()
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.frame_start(self)
+        self._renders += 1
+        self._dirty = None
+        try:
+            if scale != 1:
+                return self.render_scaled(scale)
+            return self.render_incremental() if incremental else self.render_full()
+        finally:
+            self._busy = None
+            if profiler is not None:
+                profiler.frame_end(self)
+
+    def render_incremental(self):
+        state = self.state_get()
+        boxes = None
+        if self._frame is not None and state == self._state and self._list is self.objects:
+            boxes = self.changes_get()
+        if boxes is None:
+            self._frame = self.render_full()
+            self.records_make()
+            state = self.state_get()
+        else:
+            if boxes:
+                self.repaint(boxes)
+            self._dirty = boxes
+        self._state = state
+        self._reordered = []
+        return self._frame
+
+    def render_full(self):
+        # a frame starts as a copy of what is under the objects, so the background and layers aren't drawn again
+        if self.background is None and not self.layers:
             image = PImage.new(self.mode, tuple(self.size), self.color.color)
         else:
-            image = PImage.new(self.mode, tuple(self.background.size), self.color.color)
+            image = self.under_get().copy()
         self.size = image.size
         draw = ImageDraw.Draw(image)
-        objects = self.objects
-        if self.background:
-            objects = [{"object": SodaImage(self.background), "position": Point(0, 0)}] + objects
-        for obj in objects:
+        # objects outside of the canvas are skipped
+        # culling is off for frames where most objects changed, re-indexing them costs more than drawing
+        visible = self.objects.grid.query((0, 0) + image.size, len(self.objects) // 4)
+        profiler = self.profiler
+        for obj in self.objects:
+            if visible is not None and id(obj) not in visible:
+                continue
             d = draw if obj["object"].draw_type != "image" else image
-            obj["object"].render(d, obj["position"])
+            if profiler is None:
+                obj["object"].render(d, obj["position"])
+            else:
+                profiler.render(obj, d, obj["position"])
+        return image
+
+    def render_scaled(self, scale):
+        # shapes are replaced with their preview_get(scale) copies, kept until the shape or its position changes,
+        # and put so that their centers land where the centers of the originals would be
+        size = tuple(self.background.size if self.background is not None else self.size)
+        size = (max(round(size[0] * scale), 1), max(round(size[1] * scale), 1))
+        image = PImage.new(self.mode, size, self.color.color)
+        draw = ImageDraw.Draw(image)
+        previews = self._previews
+        if len(previews) > len(self.objects) * 2 + 16:
+            current = set(map(id, self.objects))
+            for key in [key for key in previews if key not in current]:
+                del previews[key]
+        if self.background is not None:
+            key = (id(self.background), scale)
+            if self._preview_background is None or self._preview_background[0] != key:
+                self._preview_background = key, SodaImage(self.background).preview_get(scale).derived_get()
+            image.paste(self._preview_background[1], (0, 0))
+        for layer in self.layers:
+            self.composite(image, layer.render(scale=scale))
+        visible = self.objects.grid.query((0, 0) + tuple(self.size), len(self.objects) // 4)
+        profiler = self.profiler
+        for entry in self.objects:
+            if visible is not None and id(entry) not in visible:
+                continue
+            obj, position = entry["object"], entry["position"]
+            key = (obj, obj.version_get(), position.x, position.y, scale)
+            cached = previews.get(id(entry))
+            if cached is None or cached[0] != key:
+                cached = previews[id(entry)] = key, self.preview_make(obj, position, scale)
+            shape, position = cached[1]
+            d = draw if shape.draw_type != "image" else image
+            if profiler is None:
+                shape.render(d, position)
+            else:
+                profiler.render(dict(entry, object=shape), d, position)
+        return image
+
+    @staticmethod
+    def preview_make(obj, position, scale):
+        # returns the preview of the shape and the whole pixel position to render it at
+        shape = obj.preview_get(scale)
+        before, after = obj.bounds_get(position), shape.bounds_get(Point(0, 0))
+        if before is None or after is None:
+            return shape, Point(round(position.x * scale), round(position.y * scale))
+        return shape, Point(round((before[0] + before[2]) * scale / 2 - (after[0] + after[2]) / 2),
+                            round((before[1] + before[3]) * scale / 2 - (after[1] + after[3]) / 2))
+
+    @staticmethod
+    def record_make(entry):
+        obj, position = entry["object"], entry["position"]
+        return entry, obj, obj.version_get(), (position.x, position.y), obj.bounds_get(position)
+
+    def records_make(self):
+        # records objects as they are in a fully rendered frame
+        self._rendered = {id(entry): self.record_make(entry) for entry in self.objects}
+        self._order = [id(entry) for entry in self.objects]
+        self._list, self._sequence = self.objects, self.objects.order
+        self.objects.settle()
+        self._pending.clear()
+
+    def changes_get(self):
+        # updates records of objects changed since the previous incremental render: the ones in the journal
+        # of the object list and volatile ones with other versions, so the cost depends on what changed
+        # returns a list of boxes to repaint (None if the whole frame has to be rendered)
+        full = (0, 0) + tuple(self.size)
+        objects, records = self.objects, self._rendered
+        objects.settle()
+        changed = list(self._pending.values())
+        self._pending.clear()
+        for key, entry in objects.volatile.items():
+            record = records.get(key)
+            obj, position = entry["object"], entry["position"]
+            if record is None or record[1] is not obj or record[3] != (position.x, position.y) or \
+                    record[2] != obj.version_get():
+                changed.append(entry)
+        boxes = []
+        for entry in changed:
+            record = records.get(id(entry))
+            new = self.record_make(entry)
+            if record is not None and record[1] is new[1] and record[2:4] == new[2:4]:
+                continue
+            records[id(entry)] = new
+            boxes.append(Utils.default(new[4], full))
+            if record is not None:
+                boxes.append(Utils.default(record[4], full))
+        if objects.order != self._sequence:
+            order = [id(entry) for entry in objects]
+            current = set(order)
+            for key in [key for key in records if key not in current]:
+                boxes.append(Utils.default(records.pop(key)[4], full))
+            # objects moved in z-order only change pixels in their own boxes
+            stable = set(self._order) - set(self._reordered)
+            if [key for key in self._order if key in current and key in stable] != \
+                    [key for key in order if key in stable]:
+                return None
+            boxes += [Utils.default(records[key][4], full) for key in self._reordered if key in records]
+            self._order, self._sequence = order, objects.order
+        boxes = [(max(box[0], 0), max(box[1], 0), min(box[2], full[2]), min(box[3], full[3])) for box in boxes]
+        boxes = [box for box in boxes if box[0] < box[2] and box[1] < box[3]]
+        if sum((box[2] - box[0]) * (box[3] - box[1]) for box in boxes) > full[2] * full[3] // 2:
+            return None
+        return self.boxes_merge(boxes)
+
+    @staticmethod
+    def boxes_merge(boxes):
+        merged = []
+        for box in boxes:
+            i = 0
+            while i < len(merged):
+                if bounds_intersect(box, merged[i]):
+                    box = bounds_union(box, merged.pop(i))
+                    i = 0
+                else:
+                    i += 1
+            merged.append(box)
+        return merged
+
+    def repaint(self, boxes):
+        # objects are drawn at their own coordinates on a canvas-sized scratch image, shifting them to a tile
+        # would change how PIL rounds fractional coordinates; only objects the grid finds in the boxes are drawn
+        scratch = self._scratch
+        if scratch is None or scratch.size != self._frame.size or scratch.mode != self._frame.mode:
+            scratch = self._scratch = PImage.new(self.mode, self._frame.size, self.color.color)
+        under = None if self.background is None and not self.layers else self.under_get()
+        for box in boxes:
+            if under is None:
+                scratch.paste(self.color.color, box)
+            else:
+                scratch.paste(under.crop(box), box[:2])
+        draw = ImageDraw.Draw(scratch)
+        profiler = self.profiler
+        found = {}
+        for box in boxes:
+            found.update(self.objects.grid.query(box))
+        for entry in self.entries_sort(found):
+            d = draw if entry["object"].draw_type != "image" else scratch
+            if profiler is None:
+                entry["object"].render(d, entry["position"])
+            else:
+                profiler.render(entry, d, entry["position"])
+        for box in boxes:
+            self._frame.paste(scratch.crop(box), box[:2])
+
+    def render_box(self, box):
+        # renders the (x0, y0, x1, y1) part of the canvas, objects that don't intersect it are skipped
+        # draw type shapes are drawn at their canvas positions through a TranslatedDraw, image type ones get the
+        # box as an image, so the pixels are the same as of render() also for fractional coordinates
+        image = PImage.new(self.mode, (box[2] - box[0], box[3] - box[1]), self.color.color)
+        origin = (box[0], box[1])
+        draw = TranslatedDraw.create(image, origin)
+        # ImageDraw.Draw(image) of image type shapes (ShapeBatch draws its fractional boxes that way) translates too
+        image.getdraw = partial(TranslatedDraw.create, image, origin, origin)
+        offset = Point(-box[0], -box[1])
+        if self.background is not None:
+            self.background_get().render(image, offset)
+        for layer in self.layers:
+            self.composite(image, layer.render_box(box))
+        profiler = self.profiler
+        for entry in self.entries_sort(self.objects.grid.query(box)):
+            if entry["object"].draw_type != "image":
+                d, position = draw, entry["position"]
+            else:
+                d, position = image, entry["position"] + offset
+            if profiler is None:
+                entry["object"].render(d, position)
+            else:
+                profiler.render(entry, d, position)
+        del image.getdraw
         return image
 
-    def save(self, file, extension="png"):
-        self.render().save(file, extension)
+    def tiles(self, height=256, width=None):
+        # yields (box, image) tiles row by row, full-width bands if width is None
+        # only one tile is kept in memory, the result is the same as of render()
+        size = tuple(self.background.size) if self.background is not None else tuple(self.size)
+        width = Utils.default(width, size[0])
+        for y in range(0, size[1], height):
+            for x in range(0, size[0], width):
+                box = (x, y, min(x + width, size[0]), min(y + height, size[1]))
+                yield box, self.render_box(box)
+
+    def save(self, file, extension="png", band=None, **params):
+        # with band (rows per band), the image is rendered and written band by band, png and tiff are supported
+        # params go to the encoder: compress_level (png, 0-9), quality (jpeg, webp), method (webp, 0-6), ...
+        if band is None:
+            image = self.render()
+            if extension.lower() in ("jpg", "jpeg") and image.mode not in ("RGB", "L", "CMYK"):
+                image = image.convert("RGB")
+            image.save(file, extension, **params)
+            return
+        size = tuple(self.background.size) if self.background is not None else tuple(self.size)
+        with BandWriter.create(file, self.mode, size, extension, **params) as writer:
+            for box, image in self.tiles(band):
+                writer.write(image)
 
     def __rshift__(self, file):
         self.save(file)
@@ -602,29 +2537,828 @@ class Canvas:
     def gif(self):
         return GIF(self)
 
-    def to_bytes(self, extension="png"):
+    def to_bytes(self, extension="png", **params):
+        # getvalue hands over the buffer of BytesIO instead of reading it into a copy
+        bio = io.BytesIO()
+        self.save(bio, extension, **params)
+        return bio.getvalue()
+
+    def to_buffer(self, extension="png", **params):
+        # the encoded image as a memoryview of the buffer it was written to, without copying it
+        bio = io.BytesIO()
+        self.save(bio, extension, **params)
+        return bio.getbuffer()
+
+    def pixels(self):
+        # raw pixels of the last rendered image (in the mode of the canvas, rows top to bottom), not encoded
+        # PIL keeps pixels in blocks of rows that can't be exposed as one buffer, so they are copied on every call
+        return memoryview(self.image_get().tobytes())
+
+    @property
+    def __array_interface__(self):
+        # numpy.asarray(canvas) is a read-only array of shape (height, width, bands) of the current image,
+        # made from a copy of the pixels, like numpy.asarray(image) of PIL
+        return self.image_get().__array_interface__
+
+    def to_scene(self, binary=True):
+        # returns the canvas with its objects in the soda scene format, bytes or a JSON string
+        return Scene.dumps(self, binary)
+
+    @staticmethod
+    def from_scene(data):
+        return Scene.loads(data)
+
+
+# size[, color, mode, background, incremental, profiler, static, name]
+class Layer(Canvas):
+    # a transparent canvas of Canvas.layer_add, objects are put on it as on any canvas
+    # a layer is rendered again when one of its objects changes, checking it costs what changed (see version_get)
+    # static layers at the bottom are flattened with the background of their canvas into one cached image
+    def __init__(self, size=(1000, 1000), color=(0, 0, 0, 0), mode="RGBA", background=None, incremental=False,
+                 profiler=None, static=False, name=None):
+        super().__init__(size, color, mode, background, incremental, profiler)
+        self.static = static
+        self.name = name
+        self._refreshed = 0
+        self._frozen = None
+
+    def refresh(self):
+        # renders a static layer again on the next frame, for changes the canvas doesn't see
+        # (pixels of a PIL image drawn by a SodaImage changed in place)
+        self._refreshed += 1
+
+    def key_get(self):
+        # identifies the current image of the layer
+        return id(self), self.static, self.version_get(), self._refreshed
+
+    def image_get(self):
+        if not self.static:
+            return super().image_get()
+        key = self.key_get()
+        if self._frozen is None or self._frozen[0] != key:
+            self._frozen = key, self.render()
+        return self._frozen[1]
+
+
+class Scene:
+    # compact scene format: shapes (canvases included), colors and images are kept in tables,
+    # shapes refer to each other, to colors and to images by index; shared objects stay shared
+    # images are stored once per content hash: zlib-compressed raw pixels, base64 in the JSON variant
+    # other shapes can be added with Scene.register(cls, dump, load)
+    version = 1
+    magic = b"SODA"
+    handlers = {}
+
+    def __init__(self):
+        self.shapes = []
+        self.refs = {}
+        self.colors = []
+        self.color_refs = {}
+        self.images = {}
+        self.image_refs = {}
+        self.blobs = {}
+        self.stamp = None
+
+    @classmethod
+    def register(cls, shape_class, dump, load):
+        # dump(scene, shape) returns a list of JSON values, load(scene, shape_class, fields) returns the shape
+        cls.handlers[shape_class.__name__] = shape_class, dump, load
+
+    # dumping
+
+    def color_ref(self, color):
+        if color is None:
+            return -1
+        if id(color) not in self.color_refs:
+            self.color_refs[id(color)] = len(self.colors)
+            self.colors.append(list(color.color))
+        return self.color_refs[id(color)]
+
+    def image_ref(self, image):
+        if id(image) not in self.image_refs:
+            data = image.tobytes()
+            digest = hashlib.sha1("{} {} ".format(image.mode, image.size).encode() + data).hexdigest()
+            if digest not in self.images:
+                self.images[digest] = {"mode": image.mode, "size": list(image.size)}
+                if image.mode == "P":
+                    self.images[digest]["palette"] = [image.palette.mode, image.getpalette(image.palette.mode)]
+                self.blobs[digest] = zlib.compress(data)
+            self.image_refs[id(image)] = image, digest
+        return self.image_refs[id(image)][1]
+
+    def shape_ref(self, shape):
+        if shape is None:
+            return -1
+        if id(shape) in self.refs:
+            if self.refs[id(shape)] is None:
+                raise ValueError("canvas is nested in itself")
+            return self.refs[id(shape)]
+        name = type(shape).__name__
+        if name not in self.handlers or self.handlers[name][0] is not type(shape):
+            raise TypeError("{} can't be stored in a scene, see Scene.register".format(type(shape).__name__))
+        self.refs[id(shape)] = None
+        record = [name] + self.handlers[name][1](self, shape)
+        self.refs[id(shape)] = len(self.shapes)
+        self.shapes.append(record)
+        return self.refs[id(shape)]
+
+    @classmethod
+    def dump(cls, canvas):
+        # returns the scene as a dict of JSON values and a dict of compressed image blobs by hash
+        scene = cls()
+        root = scene.shape_ref(canvas)
+        return {"format": "soda", "version": cls.version, "root": root, "colors": scene.colors,
+                "images": scene.images, "shapes": scene.shapes}, scene.blobs
+
+    @classmethod
+    def dumps(cls, canvas, binary=True):
+        meta, blobs = cls.dump(canvas)
+        if not binary:
+            for digest, blob in blobs.items():
+                meta["images"][digest]["data"] = base64.b64encode(blob).decode()
+            return json.dumps(meta, separators=(",", ":"))
+        offset = 0
+        for digest, blob in blobs.items():
+            meta["images"][digest]["blob"] = [offset, len(blob)]
+            offset += len(blob)
+        header = zlib.compress(json.dumps(meta, separators=(",", ":")).encode())
+        return b"".join([cls.magic, struct.pack(">BI", cls.version, len(header)), header] + list(blobs.values()))
+
+    # loading
+
+    @classmethod
+    def loads(cls, data):
+        # returns a Canvas from bytes or a JSON string made by dumps
+        if isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:4]) == cls.magic:
+            version, length = struct.unpack(">BI", bytes(data[4:9]))
+            meta = json.loads(zlib.decompress(data[9:9 + length]))
+            start = 9 + length
+            blob = lambda record: zlib.decompress(data[start + record["blob"][0]:start + sum(record["blob"])])
+        else:
+            meta = json.loads(data)
+            blob = lambda record: zlib.decompress(base64.b64decode(record["data"]))
+        if meta.get("format") != "soda" or meta.get("version", 0) > cls.version:
+            raise ValueError("not a soda scene of a supported version")
+        scene = cls()
+        scene.colors = [Scene.color_make(color) for color in meta["colors"]]
+        for digest, record in meta["images"].items():
+            image = PImage.frombytes(record["mode"], tuple(record["size"]), blob(record))
+            if "palette" in record:
+                image.putpalette(record["palette"][1], record["palette"][0])
+            scene.images[digest] = image
+        scene.stamp = tick()
+        for record in meta["shapes"]:
+            shape_class, dump, load = cls.handlers[record[0]]
+            scene.shapes.append(load(scene, shape_class, record[1:]))
+        return scene.shapes[meta["root"]]
+
+    @staticmethod
+    def color_make(color, new=Color.__new__, set_=object.__setattr__):
+        result = new(Color)
+        set_(result, "red", color[0])
+        set_(result, "green", color[1])
+        set_(result, "blue", color[2])
+        set_(result, "opacity", color[3])
+        set_(result, "_version", version_clock)
+        set_(result, "_watchers", None)
+        return result
+
+    def color_get(self, ref):
+        return None if ref < 0 else self.colors[ref]
+
+    def shape_get(self, ref):
+        return None if ref < 0 else self.shapes[ref]
+
+    def make(self, shape_class, state):
+        # creates a shape without its constructor, state is the __dict__ of the shape
+        shape = shape_class.__new__(shape_class)
+        shape.__dict__.update(state)
+        shape.__dict__["_version"] = self.stamp
+        return shape
+
+    # built-in shapes
+
+    def polygon_dump(self, shape):
+        vertices = shape.vertices
+        flat = vertices.ravel().tolist() if is_array(vertices) else \
+            [value for vertex in vertices for value in vertex]
+        return [self.color_ref(shape.color), flat]
+
+    def polygon_load(self, shape_class, fields):
+        flat = fields[1]
+        if numpy is not None and len(flat) >= Polygon.array_from * 2:
+            vertices = numpy.array(flat, dtype=float).reshape(-1, 2)
+        else:
+            vertices = [[flat[i], flat[i + 1]] for i in range(0, len(flat), 2)]
+        return self.make(shape_class, {"color": self.color_get(fields[0]), "_vertices": vertices})
+
+    def roundrect_dump(self, shape):
+        return [self.color_ref(shape.color), list(shape.size), list(shape.radius), list(shape.position)]
+
+    def roundrect_load(self, shape_class, fields):
+        return self.make(shape_class, {"_shapes": None, "_shapes_key": None, "color": self.color_get(fields[0]),
+                                       "size": tuple(fields[1]), "radius": tuple(fields[2]),
+                                       "position": tuple(fields[3])})
+
+    def ellipse_dump(self, shape):
+        record = [self.color_ref(shape.color), shape.center.x, shape.center.y, shape.x_radius, shape.y_radius]
+        return record + [shape.start, shape.stop] if isinstance(shape, Pieslice) else record
+
+    def ellipse_load(self, shape_class, fields):
+        state = {"color": self.color_get(fields[0]), "center": Point(fields[1], fields[2]),
+                 "x_radius": fields[3], "y_radius": fields[4]}
+        if len(fields) > 5:
+            state["start"], state["stop"] = fields[5], fields[6]
+        return self.make(shape_class, state)
+
+    def text_dump(self, shape):
+        if not isinstance(shape.font_[0], str):
+            raise TypeError("text with a font object instead of a font path can't be stored in a scene")
+        return [self.color_ref(shape.color), shape.text, shape.font_[0], shape.font_[1],
+                shape.position.x, shape.position.y, shape.align]
+
+    def text_load(self, shape_class, fields):
+        return self.make(shape_class, {"text": fields[1], "font": font_get(fields[2], fields[3]),
+                                       "font_": [fields[2], fields[3]], "color": self.color_get(fields[0]),
+                                       "position": Point(fields[4], fields[5]), "align": fields[6]})
+
+    def mask_shape_dump(self, shape):
+        return [self.color_ref(shape.color), self.shape_ref(shape.mask), shape.position.x, shape.position.y,
+                None if shape.size is None else list(shape.size)]
+
+    def mask_shape_load(self, shape_class, fields):
+        return self.make(shape_class, {"mask": self.shape_get(fields[1]), "color": self.color_get(fields[0]),
+                                       "position": Point(fields[2], fields[3]),
+                                       "size": None if fields[4] is None else tuple(fields[4])})
+
+    def image_dump(self, shape):
+        source = self.shape_ref(shape.image) if isinstance(shape.image, Canvas) else self.image_ref(shape.image)
+        return [source, self.shape_ref(shape.mask), list(shape.size), shape.position.x, shape.position.y]
+
+    def image_load(self, shape_class, fields):
+        source = self.shapes[fields[0]] if isinstance(fields[0], int) else self.images[fields[0]]
+        return self.make(shape_class, {"_source": tick(), "_derived": {}, "mask": self.shape_get(fields[1]),
+                                       "size": tuple(fields[2]), "image": source,
+                                       "position": Point(fields[3], fields[4])})
+
+    def fitbox_dump(self, shape):
+        return [self.color_ref(shape.color), self.shape_ref(shape.initial), list(shape.box),
+                shape.position.x, shape.position.y, shape.debug]
+
+    def fitbox_load(self, shape_class, fields):
+        return self.make(shape_class, {"_fitted": None, "_hits": 0, "_misses": 0, "debug": fields[5],
+                                       "initial": self.shape_get(fields[1]), "position": Point(fields[3], fields[4]),
+                                       "color": self.color_get(fields[0]), "box": tuple(fields[2])})
+
+    def batch_dump(self, shape):
+        boxes, colors_ = shape.boxes, shape.colors
+        if numpy is not None:
+            return [numpy.asarray(boxes).ravel().tolist(), numpy.asarray(colors_).ravel().tolist()]
+        return [[value for box in boxes for value in box], [value for color in colors_ for value in color]]
+
+    def batch_load(self, shape_class, fields):
+        if numpy is not None:
+            boxes = numpy.array(fields[0], dtype=float).reshape(-1, 4)
+            colors_ = numpy.array(fields[1], dtype=numpy.uint8).reshape(-1, 4)
+        else:
+            boxes = [fields[0][i:i + 4] for i in range(0, len(fields[0]), 4)]
+            colors_ = [tuple(fields[1][i:i + 4]) for i in range(0, len(fields[1]), 4)]
+        return self.make(shape_class, {"boxes": boxes, "colors": colors_})
+
+    def point_dump(self, shape):
+        return [self.color_ref(shape.color), shape.x, shape.y]
+
+    def point_load(self, shape_class, fields):
+        point = Point(fields[1], fields[2])
+        object.__setattr__(point, "color", self.color_get(fields[0]))
+        return point
+
+    def canvas_dump(self, canvas):
+        labels, positions, shapes = [], [], []
+        for entry in canvas.objects:
+            shapes.append(self.shape_ref(entry["object"]))
+            labels.append(entry["label"])
+            positions += [entry["position"].x, entry["position"].y]
+        background = None if canvas.background is None else self.image_ref(canvas.background)
+        layers = [[layer.name, layer.static, self.shape_ref(layer)] for layer in canvas.layers]
+        return [list(canvas.size), canvas.mode, list(canvas.color.color), background, canvas.incremental,
+                labels, positions, shapes, layers]
+
+    def canvas_load(self, shape_class, fields):
+        background = None if fields[3] is None else self.images[fields[3]]
+        canvas = shape_class(tuple(fields[0]), fields[2], fields[1], background, fields[4])
+        shapes, positions = self.shapes, fields[6]
+        canvas.objects = [{"object": shapes[shape], "position": Point(positions[i * 2], positions[i * 2 + 1]),
+                           "label": label} for i, (label, shape) in enumerate(zip(fields[5], fields[7]))]
+        for name, static, layer in fields[8] if len(fields) > 8 else []:
+            layer = shapes[layer]
+            layer.name, layer.static = name, static
+            canvas.layers.append(layer)
+        return canvas
+
+
+for shape_class, dump, load in [(Polygon, Scene.polygon_dump, Scene.polygon_load),
+                                (Rectangle, Scene.polygon_dump, Scene.polygon_load),
+                                (RoundRect, Scene.roundrect_dump, Scene.roundrect_load),
+                                (Ellipse, Scene.ellipse_dump, Scene.ellipse_load),
+                                (Pieslice, Scene.ellipse_dump, Scene.ellipse_load),
+                                (Text, Scene.text_dump, Scene.text_load),
+                                (MaskShape, Scene.mask_shape_dump, Scene.mask_shape_load),
+                                (SodaImage, Scene.image_dump, Scene.image_load),
+                                (FitBox, Scene.fitbox_dump, Scene.fitbox_load),
+                                (RectangleBatch, Scene.batch_dump, Scene.batch_load),
+                                (EllipseBatch, Scene.batch_dump, Scene.batch_load),
+                                (Point, Scene.point_dump, Scene.point_load),
+                                (Canvas, Scene.canvas_dump, Scene.canvas_load),
+                                (Layer, Scene.canvas_dump, Scene.canvas_load)]:
+    Scene.register(shape_class, dump, load)
+
+
+png_signature = b"\x89PNG\r\n\x1a\n"
+
+
+# file, mode, size[, **params]
+class BandWriter:
+    # writes an image of known size from horizontal bands of full width, top to bottom
+    def __init__(self, file, mode, size, **params):
+        self.own = isinstance(file, str)
+        self.file = open(file, "wb") if self.own else file
+        self.mode = mode
+        self.size = tuple(size)
+        self.params = params
+        self.rows = 0
+        self.start()
+
+    @staticmethod
+    def create(file, mode, size, extension=None, **params):
+        if extension is None:
+            extension = path.splitext(file)[1][1:] if isinstance(file, str) else "png"
+        writers = {"png": PNGBandWriter, "tif": TIFFBandWriter, "tiff": TIFFBandWriter}
+        if extension.lower() not in writers:
+            raise ValueError("unsupported format for banded saving: {}".format(extension))
+        return writers[extension.lower()](file, mode, size, **params)
+
+    def write(self, image):
+        if image.size[0] != self.size[0] or self.rows + image.size[1] > self.size[1]:
+            raise ValueError("band {} doesn't fit the image {} at row {}".format(image.size, self.size, self.rows))
+        if image.mode != self.mode:
+            image = image.convert(self.mode)
+        self.band_write(image)
+        self.rows += image.size[1]
+
+    def close(self):
+        if self.rows != self.size[1]:
+            raise ValueError("{} of {} rows were written".format(self.rows, self.size[1]))
+        self.finish()
+        if self.own:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if args[0] is None:
+            self.close()
+        elif self.own:
+            self.file.close()
+
+    # next methods are implemented by formats
+
+    def start(self):
+        pass
+
+    def band_write(self, image):
+        pass
+
+    def finish(self):
+        pass
+
+
+class PNGBandWriter(BandWriter):
+    # rows are deflated as they come (filter type 0), compress_level is 0-9
+    types = {"L": 0, "LA": 4, "RGB": 2, "RGBA": 6}
+
+    def start(self):
+        if self.mode not in self.types:
+            self.mode = "RGBA" if "A" in self.mode or self.mode == "P" else "RGB"
+        self.compressor = zlib.compressobj(self.params.get("compress_level", 6))
+        self.file.write(png_signature)
+        PngImagePlugin.putchunk(self.file, b"IHDR", struct.pack(">IIBBBBB", self.size[0], self.size[1], 8,
+                                                                 self.types[self.mode], 0, 0, 0))
+
+    def band_write(self, image):
+        data = image.tobytes()
+        stride = len(data) // image.size[1]
+        rows = b"".join(b"\0" + data[row:row + stride] for row in range(0, len(data), stride))
+        self.chunk_write(self.compressor.compress(rows))
+
+    def chunk_write(self, data):
+        if data:
+            PngImagePlugin.putchunk(self.file, b"IDAT", data)
+
+    def finish(self):
+        self.chunk_write(self.compressor.flush())
+        PngImagePlugin.putchunk(self.file, b"IEND", b"")
+
+
+class TIFFBandWriter(BandWriter):
+    # uncompressed strips of band height, the directory is written first, so the file doesn't have to be seekable
+    # band height is taken from the first band, all bands but the last have to be the same
+    types = {"L": (1, 1), "LA": (1, 2), "RGB": (2, 3), "RGBA": (2, 4)}
+
+    def start(self):
+        if self.mode not in self.types:
+            self.mode = "RGBA" if "A" in self.mode or self.mode == "P" else "RGB"
+        self.strip = None
+
+    def header_write(self, strip):
+        photometric, samples = self.types[self.mode]
+        stride = self.size[0] * samples
+        strips = [min(strip, self.size[1] - row) * stride for row in range(0, self.size[1], strip)]
+        entries = [(256, 4, [self.size[0]]), (257, 4, [self.size[1]]), (258, 3, [8] * samples), (259, 3, [1]),
+                   (262, 3, [photometric]), (273, 4, [0] * len(strips)), (277, 3, [samples]),
+                   (278, 4, [strip]), (279, 4, strips), (284, 3, [1])]
+        if samples in (2, 4):
+            entries.append((338, 3, [2]))
+        # values longer than 4 bytes are written after the directory
+        directory = 8 + 2 + len(entries) * 12 + 4
+        extra = b""
+        data = directory + sum(len(values) * (2 if kind == 3 else 4) for tag, kind, values in entries
+                               if len(values) * (2 if kind == 3 else 4) > 4)
+        if data + sum(strips) >= 1 << 32:
+            raise ValueError("the image is too big for TIFF, use PNG")
+        offsets, offset = [], data
+        for length in strips:
+            offsets.append(offset)
+            offset += length
+        fields = b""
+        for tag, kind, values in entries:
+            values = offsets if tag == 273 else values
+            packed = struct.pack("<{}{}".format(len(values), "H" if kind == 3 else "I"), *values)
+            if len(packed) > 4:
+                fields += struct.pack("<HHII", tag, kind, len(values), directory + len(extra))
+                extra += packed
+            else:
+                fields += struct.pack("<HHI", tag, kind, len(values)) + packed.ljust(4, b"\0")
+        self.file.write(b"II*\0" + struct.pack("<I", 8) + struct.pack("<H", len(entries)) + fields +
+                        struct.pack("<I", 0) + extra)
+
+    def band_write(self, image):
+        if self.strip is None:
+            self.strip = image.size[1]
+            self.header_write(self.strip)
+        elif image.size[1] != self.strip and self.rows + image.size[1] != self.size[1]:
+            raise ValueError("bands have to be {} rows high".format(self.strip))
+        self.file.write(image.tobytes())
+
+    def finish(self):
+        if self.strip is None:
+            self.header_write(max(self.size[1], 1))
+
+
+def frame_difference(previous, image):
+    # returns the box of pixels that differ between two frames of the same size, None if there are none
+    if image.mode != previous.mode or image.mode not in ("RGB", "RGBA", "L", "LA"):
+        previous, image = previous.convert("RGBA"), image.convert("RGBA")
+    difference = ImageChops.difference(previous, image)
+    if difference.mode in ("RGB", "L"):
+        return difference.getbbox()
+    # getbbox of images with alpha only looks at the alpha band
+    boxes = [box for box in (band.getbbox() for band in difference.split()) if box is not None]
+    if not boxes:
+        return None
+    for box in boxes[1:]:
+        boxes[0] = bounds_union(boxes[0], box)
+    return boxes[0]
+
+
+# file[, framerate, loop, **params]
+class AnimationWriter:
+    # writes frames to the file as soon as the next one is added, only two frames are kept in memory
+    # a frame that is the same as the previous one only makes the previous one longer
+    # writers with delta set write only the box of a frame that changed, over the previous frame,
+    # the corner of the box is moved to a multiple of align
+    delta = False
+    align = 1
+
+    def __init__(self, file, framerate=60, loop=0, **params):
+        self.own = isinstance(file, str)
+        self.file = open(file, "wb") if self.own else file
+        self.framerate = framerate
+        self.loop = loop
+        self.params = params
+        self.frames = 0
+        self.time = 0
+        self.size = None
+        self.previous = None
+        self.pending = None
+        self.added = 0
+        self.duplicates = 0
+        self.area = 0
+        self.seconds = 0
+        self.length = None
+        try:
+            self.offset = self.file.tell()
+        except (AttributeError, OSError):
+            self.offset = None
+
+    @staticmethod
+    def create(file, extension=None, **params):
+        if extension is None:
+            extension = path.splitext(file)[1][1:] if isinstance(file, str) else "gif"
+        writers = {"gif": GIFWriter, "png": APNGWriter, "apng": APNGWriter, "webp": WebPWriter}
+        if extension.lower() not in writers:
+            raise ValueError("unsupported animation format: {}".format(extension))
+        writer = writers[extension.lower()]
+        if not writer.available():
+            return BufferedWriter(file, writer.format, **params)
+        return writer(file, **params)
+
+    @staticmethod
+    def available():
+        # False if the installed Pillow lacks what the writer streams frames with, create() buffers them then
+        return True
+
+    def add(self, image, duration=None, changes=None):
+        # duration of the frame in milliseconds, 1000 / framerate by default
+        # changes are boxes where the frame differs from the previous one ([] if it's the same, like
+        # Canvas.dirty_get returns), without them frames are compared pixel by pixel
+        started = time.perf_counter()
+        duration = Utils.default(duration, 1000 / self.framerate)
+        if self.size is None:
+            self.size = image.size
+            self.start(image)
+            box = (0, 0) + image.size
+        elif image.size != self.size:
+            raise ValueError("frame size {} differs from animation size {}".format(image.size, self.size))
+        elif changes is None:
+            box = frame_difference(self.previous, image)
+        else:
+            box = None
+            for change in changes:
+                box = change if box is None else bounds_union(box, change)
+            if box is not None:
+                box = (max(floor(box[0]), 0), max(floor(box[1]), 0),
+                       min(ceil(box[2]), self.size[0]), min(ceil(box[3]), self.size[1]))
+                box = box if box[0] < box[2] and box[1] < box[3] else None
+        self.added += 1
+        if box is None:
+            self.pending[3] += duration
+            self.duplicates += 1
+        else:
+            if self.delta:
+                box = (box[0] - box[0] % self.align, box[1] - box[1] % self.align) + tuple(box[2:])
+            # the previous frame is kept up to date by pasting the changed box into it
+            if self.previous is None or self.previous.mode != image.mode:
+                self.previous = image.copy()
+            else:
+                self.previous.paste(image.crop(box), box[:2])
+            self.flush()
+            frame = self.previous.crop(box) if self.delta else self.previous.copy()
+            self.pending = [frame, box[:2], self.time, self.time + duration]
+        self.time += duration
+        self.seconds += time.perf_counter() - started
+
+    def __call__(self, image, duration=None, changes=None):
+        self.add(image, duration, changes)
+
+    def flush(self):
+        # writes the pending frame, its duration is known once the next different frame comes
+        if self.pending is not None:
+            started = time.perf_counter()
+            image, offset, start, stop = self.pending
+            self.pending = None
+            if self.delta:
+                self.write(image, start, stop, offset)
+            else:
+                self.write(image, start, stop)
+            self.frames += 1
+            self.area += image.size[0] * image.size[1]
+            self.seconds += time.perf_counter() - started
+
+    def stats(self):
+        # frames added and written, share of pixels encoded (1 without delta frames), encode time and size
+        written = self.frames + (self.pending is not None)
+        size = self.size or (0, 0)
+        try:
+            length = self.file.tell() - self.offset if self.offset is not None and not self.file.closed else None
+        except (AttributeError, OSError):
+            length = None
+        return {"frames": self.added, "written": written, "duplicates": self.duplicates,
+                "pixels": self.area / max(self.frames * size[0] * size[1], 1), "seconds": self.seconds,
+                "bytes": Utils.default(self.length, length)}
+
+    def close(self):
+        if self.size is not None:
+            self.flush()
+            started = time.perf_counter()
+            self.finish()
+            self.seconds += time.perf_counter() - started
+        self.length = self.stats()["bytes"]
+        self.previous = None
+        if self.own:
+            self.file.close()
+        else:
+            self.file.flush()
+        return self.stats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # next methods are implemented by the format writers, start and stop are frame times in milliseconds
+
+    def start(self, image):
+        pass
+
+    def write(self, image, start, stop):
+        pass
+
+    def finish(self):
+        pass
+
+
+class GIFWriter(AnimationWriter):
+    # changed boxes are drawn over the previous frame (disposal 1), the rest of the picture stays
+    delta = True
+    format = "GIF"
+
+    @staticmethod
+    def available():
+        return callable(getattr(GifImagePlugin, "getdata", None))
+
+    def start(self, image):
+        header = b"GIF89a" + struct.pack("<HHBBB", image.size[0], image.size[1], 0, 0, 0)
+        if self.loop is not None:
+            header += b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", self.loop) + b"\x00"
+        self.file.write(header)
+
+    def write(self, image, start, stop, offset=(0, 0), disposal=1):
+        # gif delays are in centiseconds, rounding frame times keeps the total duration exact
+        if image.mode != "P":
+            image = image.convert("RGB").quantize(self.params.get("colors", 256))
+        duration = (round(stop / 10) - round(start / 10)) * 10
+        for data in GifImagePlugin.getdata(image, offset, duration=duration, disposal=disposal,
+                                           include_color_table=True):
+            self.file.write(data)
+
+    def finish(self):
+        self.file.write(b";")
+
+
+class APNGWriter(AnimationWriter):
+    # frame count is written to the header on close, so the file has to be seekable
+    # frames are deflated into IDAT and fdAT chunks with the chunk writers PIL saves APNG with
+    format = "PNG"
+
+    @staticmethod
+    def available():
+        return (all(callable(getattr(PngImagePlugin, name, None)) for name in ("_idat", "_fdat", "putchunk")) and
+                callable(getattr(ImageFile, "_save", None)))
+
+    def start(self, image):
+        self.mode = "RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB"
+        self.sequence = 0
+        self.file.write(png_signature)
+        PngImagePlugin.putchunk(self.file, b"IHDR", struct.pack(">IIBBBBB", image.size[0], image.size[1], 8,
+                                                                 6 if self.mode == "RGBA" else 2, 0, 0, 0))
+        self.actl = self.file.tell()
+        PngImagePlugin.putchunk(self.file, b"acTL", struct.pack(">II", 0, self.loop or 0))
+
+    def write(self, image, start, stop):
+        if image.mode != self.mode:
+            image = image.convert(self.mode)
+        image.encoderconfig = (False, self.params.get("compress_level", -1))
+        PngImagePlugin.putchunk(self.file, b"fcTL", struct.pack(">IIIIIHHBB", self.sequence, image.size[0],
+                                                                 image.size[1], 0, 0, round(stop - start), 1000, 0, 0))
+        self.sequence += 1
+        if self.frames == 0:
+            output = PngImagePlugin._idat(self.file, PngImagePlugin.putchunk)
+        else:
+            output = PngImagePlugin._fdat(self.file, PngImagePlugin.putchunk, self.sequence)
+        ImageFile._save(image, output, [("zip", (0, 0) + image.size, 0, self.mode)])
+        if self.frames:
+            self.sequence = output.seq_num
+
+    def finish(self):
+        PngImagePlugin.putchunk(self.file, b"IEND", b"")
+        end = self.file.tell()
+        self.file.seek(self.actl)
+        PngImagePlugin.putchunk(self.file, b"acTL", struct.pack(">II", self.frames, self.loop or 0))
+        self.file.seek(end)
+
+
+class WebPWriter(AnimationWriter):
+    # every frame is encoded as it comes and written in an ANMF chunk, the RIFF size is written on close,
+    # so the file has to be seekable; changed boxes replace the pixels under them, their corners are even
+    delta = True
+    align = 2
+    format = "WEBP"
+
+    def start(self, image):
+        if _webp is None:
+            raise RuntimeError("Pillow is built without WebP support")
+        self.mode = "RGBA" if "A" in image.mode or image.mode == "P" else "RGB"
+        self.riff = self.file.tell()
+        width, height = image.size
+        self.file.write(b"RIFF\0\0\0\0WEBP")
+        self.chunk(b"VP8X", struct.pack("<I", 0x12 if self.mode == "RGBA" else 0x02)
+                   + (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little"))
+        self.chunk(b"ANIM", struct.pack("<IH", 0, self.loop or 0))
+
+    def chunk(self, name, data):
+        self.file.write(name + struct.pack("<I", len(data)) + data + b"\0" * (len(data) & 1))
+
+    def write(self, image, start, stop, offset=(0, 0)):
+        # the still image bitstream (ALPH and VP8, or VP8L) of the frame goes into the ANMF chunk
+        if image.mode != self.mode:
+            image = image.convert(self.mode)
         bio = io.BytesIO()
-        self.save(bio, extension)
-        bio.seek(0)
-        return bio.read()
-    
+        image.save(bio, "WEBP", lossless=self.params.get("lossless", False), quality=self.params.get("quality", 80),
+                   method=self.params.get("method", 0))
+        data = bio.getbuffer()
+        frame, position = [], 12
+        while position + 8 <= len(data):
+            name, size = bytes(data[position:position + 4]), struct.unpack("<I", data[position + 4:position + 8])[0]
+            stop_ = position + 8 + size + (size & 1)
+            if name in (b"ALPH", b"VP8 ", b"VP8L"):
+                frame.append(data[position:stop_])
+            position = stop_
+        # delays are in milliseconds, rounding frame times keeps the total duration exact
+        duration = min(round(stop) - round(start), 0xffffff)
+        header = b"".join(value.to_bytes(3, "little") for value in
+                          (offset[0] // 2, offset[1] // 2, image.size[0] - 1, image.size[1] - 1, duration))
+        self.chunk(b"ANMF", header + b"\x02" + b"".join(frame))
+
+    def finish(self):
+        end = self.file.tell()
+        self.file.seek(self.riff + 4)
+        self.file.write(struct.pack("<I", end - self.riff - 8))
+        self.file.seek(end)
+
+
+class BufferedWriter(AnimationWriter):
+    # keeps the frames and saves them with save_all of PIL on close, for formats whose streaming writer
+    # isn't available with the installed Pillow; repeated frames are still merged into one
+    def __init__(self, file, format, framerate=60, loop=0, **params):
+        super().__init__(file, framerate, loop, **params)
+        self.format = format
+        self.images = []
+        self.durations = []
+
+    def write(self, image, start, stop):
+        self.images.append(image)
+        self.durations.append(round(stop) - round(start))
+
+    def finish(self):
+        params = dict(self.params, save_all=True, append_images=self.images[1:], duration=self.durations)
+        if self.loop is not None:
+            params["loop"] = self.loop
+        self.images[0].save(self.file, self.format, **params)
+        self.images = []
 
+
+# canvas[, file, framerate]
 class GIF:
-    def __init__(self, canvas=None):
+    def __init__(self, canvas=None, file=None, framerate=60, **params):
+        # with a file, frames are streamed to it as they are added instead of being kept until save
         self.images = []
         self.canvas = canvas
+        self.writer = AnimationWriter.create(file, framerate=framerate, **params) if file is not None else None
+        self.renders = None
 
     def __call__(self, image=None):
-        image = image or self.canvas.render()
-        bio = io.BytesIO()
-        image.save(bio, "png")
-        bio.seek(0)
-        self.images.append(imageio.imread(bio))
+        changes = None
+        if image is None:
+            # when the previous frame was the last render of the canvas, the canvas knows what changed
+            renders = self.canvas.dirty_get()[0]
+            image = self.canvas.render()
+            count, dirty = self.canvas.dirty_get()
+            if renders == self.renders and count == renders + 1:
+                changes = dirty
+            self.renders = count
+        else:
+            self.renders = None
+        if self.writer is not None:
+            self.writer.add(image, changes=changes)
+        else:
+            self.images.append(numpy.array(image))
+
+    def stats(self):
+        return self.writer.stats() if self.writer is not None else None
+
+    def close(self):
+        if self.writer is not None:
+            return self.writer.close()
 
     def __rshift__(self, args):
+        if self.writer is not None:
+            return self.close()
+        framerate = 60
         if type(args) == str:
             name = args
-            framerate = 60
         elif not args:
             letter_set = "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM1234567890"
             name = "anim-{}".format("".join([random.choice(letter_set) for i in range(10)]))
@@ -633,6 +3367,77 @@ class GIF:
         imageio.mimsave(name.strip(".gif") + ".gif", self.images, duration=1 / framerate)
 
 
+def executor_make(workers, threads=False):
+    if threads:
+        return ThreadPoolExecutor(workers)
+    # process pools pull in most of multiprocessing, so they are imported here
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(workers)
+
+
+def frame_get(frame, index):
+    image = frame(index)
+    return image.render() if isinstance(image, Canvas) else image
+
+
+def frame_share(frame, index):
+    # runs in a worker process, pixels are passed back through shared memory instead of pickling the image
+    image = frame_get(frame, index)
+    data = image.tobytes()
+    memory = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    memory.buf[:len(data)] = data
+    memory.close()
+    # the block is unlinked by the parent process, so the worker doesn't track it
+    resource_tracker.unregister(memory._name, "shared_memory")
+    return memory.name, image.mode, image.size, len(data)
+
+
+def frame_take(name, mode, size, length):
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        return PImage.frombytes(mode, size, bytes(memory.buf[:length]))
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def frame_drop(name, mode, size, length):
+    # unlinks the block of a frame that won't be passed on
+    memory = shared_memory.SharedMemory(name=name)
+    memory.close()
+    memory.unlink()
+
+
+# frame, frames, gif[, workers, threads, window]
+def animate(frame, frames, gif, workers=None, threads=False, window=None):
+    # frame(index) returns a Canvas or a PIL image of the frame, frames are rendered in a pool
+    # and passed to gif (GIF, AnimationWriter or any callable) in the order of indexes
+    # with processes frame has to be picklable (a module-level function), with threads it mustn't share canvases
+    if type(frames) == int:
+        frames = range(frames)
+    executor = executor_make(workers, threads)
+    window = Utils.default(window, executor._max_workers * 2)
+    task = frame_get if threads else frame_share
+    pending = []
+    try:
+        for index in frames:
+            pending.append(executor.submit(task, frame, index))
+            if len(pending) >= window:
+                gif(pending.pop(0).result() if threads else frame_take(*pending.pop(0).result()))
+        while pending:
+            gif(pending.pop(0).result() if threads else frame_take(*pending.pop(0).result()))
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+        # frames rendered but not taken (another frame failed) are in blocks nobody else unlinks
+        if not threads:
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    frame_drop(*future.result())
+    return gif
+
+
 def random_point(canvas):
     return Point(
         random.randint(0, canvas.size[0] - 1),
@@ -642,22 +3447,119 @@ def random_point(canvas):
 
 Dot = Point
 
+# [paths]
+class PluginRegistry:
+    # finds plugins by name and loads each of them once:
+    # - files named soda-<name>.py in paths (the directory of soda by default), imported with the standard
+    #   loader, so their bytecode is cached in __pycache__ and compiled again only when the source changes
+    # - installed packages declaring a "soda.plugins" entry point with the name of the plugin
+    # installed packages can also declare shapes as "soda.shapes" entry points (Star = "package.module:Star"),
+    # the module providing a shape is imported on first use of soda.<name>
+    # plugin files run with the names of soda available, as they did with connect
+    group = "soda.plugins"
+    shapes_group = "soda.shapes"
+
+    def __init__(self, paths=None):
+        self.paths = [script_path] if paths is None else list(paths)
+        self.loaded = OrderedDict()
+        self.points = None
+
+    def entry_points(self, group):
+        # the metadata of installed packages is read once, on the first lookup
+        if self.points is None:
+            from importlib import metadata
+            found = metadata.entry_points()
+            select = found.select if hasattr(found, "select") else lambda group: found.get(group, [])
+            self.points = {name: {point.name: point for point in select(group=name)}
+                           for name in (self.group, self.shapes_group)}
+        return self.points.get(group, {})
+
+    def file_get(self, name):
+        for folder in self.paths:
+            file = path.join(folder, "soda-{}.py".format(name))
+            if exists(file):
+                return file
+        return None
+
+    def available(self):
+        # {name: file or entry point value} of every plugin that can be loaded, files win over packages
+        result = {name: point.value for name, point in self.entry_points(self.group).items()}
+        for folder in reversed(self.paths):
+            if path.isdir(folder):
+                for file in sorted(os.listdir(folder)):
+                    if file.startswith("soda-") and file.endswith(".py"):
+                        result[file[5:-3]] = path.join(folder, file)
+        return result
+
+    def load(self, name, force=False):
+        # returns the module of the plugin or None if there's no such plugin
+        if name in self.loaded and not force:
+            return self.loaded[name]
+        file = self.file_get(name)
+        if file is not None:
+            module = self.file_load(name, file)
+        elif name in self.entry_points(self.group):
+            module = self.entry_points(self.group)[name].load()
+        else:
+            return None
+        self.loaded[name] = module
+        return module
+
+    def file_load(self, name, file):
+        spec = spec_from_file_location("soda_plugin_" + name.replace("-", "_"), file)
+        module = module_from_spec(spec)
+        module.__dict__.update({key: value for key, value in globals().items() if not key.startswith("__")})
+        module.soda = sys.modules[__name__]
+        sys.modules[spec.name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[spec.name]
+            raise
+        return module
+
+    def exports(self, module):
+        # names a plugin adds to soda or replaces in it
+        names = getattr(module, "__all__", None)
+        if names is not None:
+            return {name: getattr(module, name) for name in names}
+        namespace = globals()
+        return {key: value for key, value in vars(module).items() if not key.startswith("_") and
+                not isinstance(value, ModuleType) and namespace.get(key, is_) is not value}
+
+    def shape_get(self, name):
+        point = self.entry_points(self.shapes_group).get(name)
+        return None if point is None else point.load()
+
+
+plugins = PluginRegistry()
+
+
+def __getattr__(name):
+    # shapes of installed plugins are imported on first use
+    if not name.startswith("_"):
+        shape = plugins.shape_get(name)
+        if shape is not None:
+            globals()[name] = shape
+            return shape
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
 def connect(names, force=False):
+    # loads plugins into the namespace of soda, results are 1 if loaded, 0 if it already was, -1 if not found
     results = {}
     if type(names) == str:
         names = names.replace(" ", "").split(",")
     for name in names:
-        name_ = script_path + "soda-{}.py".format(name)
         if name in modules and not force:
-            result = 0
-        elif exists(name_):
-            if name in modules:
-                modules.remove(name)
-            with open(name_, 'rb') as file:
-                exec(compile(file.read(), name_, 'exec'), globals())
-            result = 1
+            results[name] = 0
+            continue
+        module = plugins.load(name, force=force)
+        if module is None:
+            results[name] = -1
+            continue
+        globals().update(plugins.exports(module))
+        if name not in modules:
             modules.append(name)
-        else:
-            result = -1
-        results[name] = result
-    return results
\ No newline at end of file
+        results[name] = 1
+    return results
@@ -0,0 +1,648 @@
+import copy
+import io
+import os
+import pickle
+import random
+import subprocess
+import sys
+from collections import Counter
+from importlib import metadata
+from os import path
+
+import pytest
+from PIL import Image, ImageDraw, ImageSequence
+
+import soda
+
+FONT = path.join(path.dirname(path.abspath(__file__)), "DejaVuSans.ttf")
+# median time of import soda in a fresh interpreter in seconds, most of it is importing PIL
+IMPORT_BUDGET = 0.2
+
+
+def test_text_bounds_cover_ink():
+    # bounds of text have to cover every pixel it draws, descenders included, or canvases leave stale pixels
+    r = random.Random(1)
+    for i in range(200):
+        text = r.choice(["gjy", "Hello\nqpj", "ÅÄg", "W", "fj|", "a\nb\nyyy", "..."])
+        t = soda.Text(text, FONT, r.choice([8, 13, 40, 90]), align=r.choice("cse") + r.choice("cse"))
+        position = soda.Point(r.uniform(100, 200), r.uniform(100, 200))
+        canvas = soda.Canvas((400, 400), (0, 0, 0, 0))
+        canvas.put(t, position)
+        ink = canvas.render().getbbox()
+        bounds = t.bounds_get(position)
+        assert bounds[0] <= ink[0] and bounds[1] <= ink[1] and bounds[2] >= ink[2] and bounds[3] >= ink[3], \
+            (text, t.font_[1], t.align, bounds, ink)
+
+
+def test_text_change_repaints_descenders():
+    canvas = soda.Canvas((300, 300), "white", incremental=True)
+    text = soda.Text("gjy", FONT, 40, align="cc")
+    canvas.put(text, (190, 170))
+    canvas.render()
+    text.text = "AAA"
+    assert canvas.render().tobytes() == canvas.render(incremental=False).tobytes()
+
+
+def test_bands_and_tiles_match_render():
+    # bands and tiles at any offset have the pixels of a full render, also for shapes at fractional coordinates
+    r = random.Random(2)
+    canvas = soda.Canvas((211, 163), "#fafafa")
+    for i in range(120):
+        x, y = r.uniform(-30, 220), r.uniform(-30, 170)
+        color = soda.hsl()
+        kind = i % 5
+        if kind == 0:
+            canvas.put(soda.Polygon([(x, y), (x + r.uniform(-60, 60), y + r.uniform(-40, 40)),
+                                     (x + r.uniform(-30, 30), y + r.uniform(-70, 70))], color))
+        elif kind == 1:
+            canvas.put(soda.Ellipse((x, y), r.uniform(1, 40), r.uniform(1, 30), color=color))
+        elif kind == 2:
+            canvas.put(soda.Pieslice((x, y), r.uniform(3, 40), color=color, start=r.uniform(0, 180), stop=300))
+        elif kind == 3:
+            canvas.put(soda.RoundRect(r.uniform(10, 60), r.uniform(10, 40), r.randint(0, 9), color, (x, y)))
+        else:
+            canvas.put(soda.Text("Tyg", FONT, r.randint(8, 30), (x, y), r.choice(["cs", "cc", "ee"]), color))
+    full = canvas.render()
+    for height, width in ((37, None), (1, None), (29, 17), (64, 53)):
+        for box, tile in canvas.tiles(height, width):
+            assert tile.tobytes() == full.crop(box).tobytes(), (height, width, box)
+
+
+def test_fitbox_debug_label_goes_away():
+    text = soda.Text("Fit me", FONT, 40)
+    box = soda.FitBox(text, (120, 40))
+    canvas = soda.Canvas((200, 100), "white")
+    canvas.put(box, (20, 20))
+    plain = canvas.render().tobytes()
+    box.debug = True
+    assert box.shape_get().text == "120x40" and text.text == "Fit me"
+    assert canvas.render().tobytes() != plain
+    box.debug = False
+    assert box.shape_get().text == "Fit me"
+    assert canvas.render().tobytes() == plain
+
+
+def test_vertices_keep_stored_values():
+    polygon = soda.Polygon([(0, 0), (1, 2), (3, 1)])
+    assert polygon.points[1].x == 1 and isinstance(polygon.points[1].x, int)
+    assert str(polygon) == "soda.Polygon((0, 0); (1, 2); (3, 1))"
+    polygon.points[2].y = 4
+    assert polygon.points[2].y == 4 and isinstance(polygon.points[2].y, int)
+    big = soda.Polygon([(i, i % 7) for i in range(100)])
+    assert type(big.points[5].x) is float and big.points[5].x == 5
+
+
+@pytest.mark.parametrize("duplicate", [copy.copy, copy.deepcopy, lambda obj: pickle.loads(pickle.dumps(obj))])
+def test_copies_of_watched_shapes(duplicate):
+    # copies leave the canvas watching the original behind, and keep its state
+    canvas = soda.Canvas((20, 20), "white", incremental=True)
+    position = soda.Point(2, 3)
+    square = soda.Rectangle(5, 4, "red", (1, 1))
+    canvas.put(square, position)
+    canvas.render()
+    point, rectangle = duplicate(position), duplicate(square)
+    assert (point.x, point.y) == (2, 3)
+    assert [(p.x, p.y) for p in rectangle.points] == [(1, 1), (6, 1), (6, 5), (1, 5)]
+    assert rectangle.color.color == (255, 0, 0, 255)
+    before = canvas.render().tobytes()
+    point.move(10, 10)
+    rectangle.points[0].move(0, 0)
+    rectangle.color_set("blue")
+    assert canvas.render().tobytes() == before
+    position.move(10, 10)
+    assert canvas.render().tobytes() != before
+
+
+def test_color_names_are_parsed_once():
+    maxsize = soda.colors.maxsize
+    soda.colors.clear()
+    soda.colors.resize(2)
+    try:
+        assert soda.Color("red").color == (255, 0, 0, 255)
+        assert soda.Color("#00ff0080").color == (0, 255, 0, 128)
+        assert soda.Color("red").color == soda.Color.parse("red") == (255, 0, 0, 255)
+        # the least recently used name goes first
+        soda.Color("blue")
+        assert soda.colors.cache_info()["size"] == 2
+        soda.Color("#00ff0080")
+        info = soda.colors.cache_info()
+        assert (info["hits"], info["misses"]) == (2, 4)
+        assert soda.Color((1, 2, 3)).color == (1, 2, 3, 255) and soda.colors.cache_info()["misses"] == 4
+    finally:
+        soda.colors.resize(maxsize)
+
+
+def test_webp_frames_are_written_as_they_come():
+    canvas = soda.Canvas((61, 43), "white")
+    square = soda.Rectangle(7, color="red")
+    canvas.put(square, (3, 5))
+    frames = []
+    file = io.BytesIO()
+    writer = soda.AnimationWriter.create(file, "webp", framerate=25, lossless=True)
+    for i in range(12):
+        canvas.move(0, (3 + i * 3, 5 + i % 4 * 7))
+        frames.append(canvas.render().convert("RGB"))
+        writer.add(frames[-1])
+        assert writer.stats()["bytes"] > 0
+    writer.close()
+    file.seek(0)
+    image = Image.open(file)
+    assert image.n_frames == 12
+    for i, frame in enumerate(ImageSequence.Iterator(image)):
+        assert frame.convert("RGB").tobytes() == frames[i].tobytes()
+        assert frame.info["duration"] == 40
+
+
+def test_gif_skips_repeated_frames_and_writes_changed_boxes():
+    canvas = soda.Canvas((61, 43), "white")
+    canvas.put(soda.Rectangle(7, color="red"), (3, 5))
+    frames = []
+    file = io.BytesIO()
+    writer = soda.AnimationWriter.create(file, "gif", framerate=25)
+    for i in range(8):
+        # every third frame repeats the one before it
+        if i % 3 != 2:
+            canvas.move(0, (3 + i * 3, 5))
+        frames.append(canvas.render().convert("RGB"))
+        writer.add(frames[-1])
+    stats = writer.close()
+    assert (stats["frames"], stats["written"], stats["duplicates"]) == (8, 6, 2)
+    assert 0 < stats["pixels"] < 0.5
+    file.seek(0)
+    image = Image.open(file)
+    written = [0, 1, 3, 4, 6, 7]
+    durations = [40, 80, 40, 80, 40, 40]
+    for i, frame in enumerate(ImageSequence.Iterator(image)):
+        assert frame.convert("RGB").tobytes() == frames[written[i]].tobytes()
+        assert frame.info["duration"] == durations[i]
+        if i:
+            # a moved square only changes the box around its old and new places
+            old, new = 3 + written[i - 1] * 3, 3 + written[i] * 3
+            assert frame.dispose_extent == (old, 5, new + 8, 13)
+
+
+@pytest.mark.parametrize("extension", ["gif", "png"])
+def test_animations_are_buffered_without_streaming_writers(extension, monkeypatch):
+    # the streaming writers use internals of PIL, without them frames are saved with save_all on close
+    assert soda.GIFWriter.available() and soda.APNGWriter.available()
+    for writer in (soda.GIFWriter, soda.APNGWriter):
+        monkeypatch.setattr(writer, "available", staticmethod(lambda: False))
+    canvas = soda.Canvas((30, 20), "white")
+    canvas.put(soda.Rectangle(5, color="red"), (3, 5))
+    frames = []
+    file = io.BytesIO()
+    writer = soda.AnimationWriter.create(file, extension, framerate=25)
+    assert isinstance(writer, soda.BufferedWriter)
+    for i in range(6):
+        if i != 3:
+            canvas.move(0, (3 + i * 3, 5))
+        frames.append(canvas.render().convert("RGB"))
+        writer.add(frames[-1])
+    stats = writer.close()
+    assert (stats["frames"], stats["written"], stats["duplicates"]) == (6, 5, 1)
+    file.seek(0)
+    image = Image.open(file)
+    written = [0, 1, 2, 4, 5]
+    durations = [40, 40, 80, 40, 40]
+    assert image.n_frames == 5
+    for i, frame in enumerate(ImageSequence.Iterator(image)):
+        assert frame.convert("RGB").tobytes() == frames[written[i]].tobytes()
+        assert frame.info["duration"] == durations[i]
+
+
+def test_batches_match_separate_shapes():
+    r = random.Random(3)
+    positions = [(r.randint(-20, 130), r.randint(-20, 90)) for i in range(400)]
+    sizes = [(r.randint(0, 25), r.randint(0, 25)) for i in range(400)]
+    colors = [(r.randint(0, 255), r.randint(0, 255), r.randint(0, 255), r.randint(0, 255)) for i in range(400)]
+    for mode in ("RGBA", "RGB"):
+        batch, single = soda.Canvas((120, 80), "white", mode), soda.Canvas((120, 80), "white", mode)
+        batch.put(soda.RectangleBatch(positions, sizes, colors))
+        batch.put(soda.EllipseBatch(positions[::3], [(w // 2, h // 2) for w, h in sizes[::3]], colors[::3]))
+        for position, size, color in zip(positions, sizes, colors):
+            single.put(soda.Rectangle(size[0], size[1], color, position))
+        for position, size, color in zip(positions[::3], sizes[::3], colors[::3]):
+            single.put(soda.Ellipse(position, size[0] // 2, size[1] // 2, color))
+        assert batch.render().tobytes() == single.render().tobytes()
+        # a changed instance is placed again, not taken from the last layout
+        batch.objects[0]["object"].instance_set(7, (50.5, 30, 9, 4), "blue")
+        single.objects[7]["object"].points = [(50.5, 30), (59.5, 30), (59.5, 34), (50.5, 34)]
+        single.objects[7]["object"].color_set("blue")
+        assert batch.render().tobytes() == single.render().tobytes()
+
+
+def test_loaded_scene_follows_changes():
+    # a loaded canvas watches its objects from the first render on, changes made before it are drawn too
+    canvas = soda.Canvas((40, 30), "white", incremental=True)
+    for i in range(30):
+        canvas.put(soda.Rectangle(4, 3, soda.hsl(), (i % 10 * 4, i // 10 * 8)), (0, i % 3))
+    loaded = soda.Canvas.from_scene(canvas.to_scene())
+    loaded.objects[3]["object"].color_set("red")
+    loaded.objects[4]["position"].move(1, 20)
+    for step in range(3):
+        expected = Image.new("RGBA", (40, 30), "white")
+        draw = ImageDraw.Draw(expected)
+        for entry in loaded.objects:
+            entry["object"].render(draw, entry["position"])
+        assert loaded.render().tobytes() == expected.tobytes(), step
+        loaded.objects[step]["object"].points[0].move(-2, -2)
+        loaded.objects[step + 10]["position"].move(5, 5)
+        loaded.objects[step + 20]["object"].color.change("blue")
+
+
+def frame_failing(index):
+    if index == 5:
+        raise ValueError("frame 5")
+    canvas = soda.Canvas((40, 30), "white")
+    canvas.put(soda.Rectangle(5, color="red"), (index, 3))
+    return canvas
+
+
+def test_animate_error_leaves_no_shared_memory():
+    before = set(os.listdir("/dev/shm"))
+    frames = []
+    with pytest.raises(ValueError):
+        soda.animate(frame_failing, 20, frames.append, workers=3, window=12)
+    assert set(os.listdir("/dev/shm")) - before == set()
+
+
+def test_static_layer_follows_changes_in_place():
+    canvas = soda.Canvas((60, 40), "white")
+    layer = canvas.layer_add("back", static=True)
+    square = soda.Rectangle(10, color="red")
+    position = soda.Point(5, 5)
+    layer.put(square, position)
+    canvas.put(soda.Rectangle(4, color="blue"), (40, 20))
+    canvas.render()
+    square.color_set("green")
+    assert canvas.render().getpixel((8, 8))[:3] == (0, 128, 0)
+    square.color.change("#0000ff")
+    position.move(20, 5)
+    image = canvas.render()
+    assert image.getpixel((23, 8))[:3] == (0, 0, 255) and image.getpixel((8, 8))[:3] == (255, 255, 255)
+
+
+def test_polygons_just_off_the_edges_are_drawn():
+    # PIL truncates toward zero, a polygon ending between x = -2 and -1 may still paint column 0
+    r = random.Random(4)
+    for i in range(200):
+        points = [(r.uniform(-6, -1), r.uniform(-3, 30)) for j in range(4)]
+        if i % 2:
+            points = [(y, x) for x, y in points]
+        canvas = soda.Canvas((40, 40), "white")
+        canvas.put(soda.Polygon(points, "red"))
+        expected = Image.new("RGBA", (40, 40), "white")
+        ImageDraw.Draw(expected).polygon(points, fill=(255, 0, 0, 255))
+        assert canvas.render().tobytes() == expected.tobytes(), points
+
+
+def test_incremental_matches_full_render_near_edges():
+    # shapes moved around fractional negative coordinates leave no stale pixels in incremental renders,
+    # both renders have the pixels of drawing every shape without culling
+    r = random.Random(56)
+
+    def u():
+        return r.choice([r.uniform(-2.5, 0.5), r.uniform(-2.5, 0.5), r.uniform(-3, 40)])
+
+    canvas = soda.Canvas((40, 30), "white", incremental=True)
+    polygons = [soda.Polygon([(r.uniform(-5, -1), r.uniform(-3, 30)) for j in range(4)], soda.hsl()) for i in range(8)]
+    ellipses = [soda.Ellipse((u(), u()), r.uniform(0, 5), color=soda.hsl()) for i in range(4)]
+    labels = {id(shape): canvas.put(shape, (r.uniform(-2, 2), r.uniform(-2, 2))) for shape in polygons + ellipses}
+    canvas.render()
+    for step in range(300):
+        shape = r.choice(polygons + ellipses)
+        action = r.randrange(3)
+        if action == 0:
+            canvas.move(labels[id(shape)], (r.uniform(-3, 2), r.uniform(-3, 2)))
+        elif action == 1 and shape in polygons:
+            shape.points[r.randrange(4)].move(r.uniform(-5, 0), u())
+        else:
+            shape.color_set(soda.hsl())
+        expected = Image.new("RGBA", (40, 30), "white")
+        draw = ImageDraw.Draw(expected)
+        for entry in canvas.objects:
+            entry["object"].render(draw, entry["position"])
+        assert canvas.render().tobytes() == expected.tobytes(), step
+        assert canvas.render(incremental=False).tobytes() == expected.tobytes(), step
+
+
+def test_import_is_light():
+    # numpy, imageio and json are imported on first use (see LazyModule)
+    script = ("import sys, time; start = time.perf_counter(); import soda; "
+              "print(time.perf_counter() - start, *[name in sys.modules for name in ('numpy', 'imageio', 'json')])")
+    environment = dict(os.environ)
+    environment.pop("PYTHONDONTWRITEBYTECODE", None)
+    times = []
+    for run in range(6):
+        output = subprocess.run([sys.executable, "-c", script], cwd=path.dirname(path.abspath(soda.__file__)),
+                                env=environment, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        seconds, *imported = output.split()
+        assert imported == ["False"] * 3
+        times.append(float(seconds))
+    # the first run writes the bytecode cache
+    assert sorted(times[1:])[2] < IMPORT_BUDGET
+
+
+def test_fonts_are_loaded_once():
+    maxsize = soda.fonts.maxsize
+    soda.fonts.clear()
+    soda.fonts.resize(2)
+    try:
+        small = soda.font_get(FONT, 10)
+        assert soda.Text("a", FONT, 10).font is small
+        medium = soda.font_get(FONT, 11)
+        soda.font_get(FONT, 10)
+        # the least recently used font goes first
+        soda.font_get(FONT, 12)
+        assert soda.font_get(FONT, 10) is small
+        assert soda.font_get(FONT, 11) is not medium
+        info = soda.fonts.cache_info()
+        assert (info["hits"], info["misses"], info["size"]) == (3, 4, 2)
+    finally:
+        soda.fonts.resize(maxsize)
+
+
+def test_derived_images_are_kept_until_set():
+    image = soda.SodaImage(Image.new("RGB", (40, 20), "red"), size=(10, 10))
+    gray = image.derived_get("L")
+    assert gray.size == (10, 10) and gray.mode == "L"
+    assert image.derived_get("L") is gray
+    assert image.get("L") is not gray and image.get("L").tobytes() == gray.tobytes()
+    image.set(Image.new("RGB", (40, 20), "blue"))
+    assert image.derived_get("L").tobytes() != gray.tobytes()
+
+
+def test_object_list_keeps_order_and_labels():
+    # small chunks, so entries move between them
+    rng = random.Random(7)
+    objects, model = soda.ObjectList(), []
+    objects.load = 4
+    for step in range(400):
+        choice = rng.random()
+        if choice < 0.5 or not model:
+            index = rng.randint(-len(model) - 1, len(model) + 1)
+            entry = {"object": soda.Rectangle(1, 1), "position": soda.Point(step, 0), "label": None}
+            objects.insert(index, entry)
+            index = max(len(model) + index, 0) if index < 0 else index
+            model.insert(index, entry)
+        elif choice < 0.8:
+            entry = model.pop(rng.randrange(len(model)))
+            objects.remove(entry)
+        else:
+            entry = model.pop(rng.randrange(len(model)))
+            assert objects.pop(entry["label"]) is entry
+            index = rng.randrange(len(model) + 1)
+            objects.insert(index, entry)
+            model.insert(index, entry)
+        assert len(objects) == len(model) and list(map(id, objects)) == list(map(id, model))
+    assert max(map(len, objects.chunks)) <= objects.load * 2
+    for index, entry in enumerate(model):
+        assert objects.index(entry) == index and objects[index] is entry
+        assert objects.get(entry["label"]) is entry and entry in objects
+    with pytest.raises(ValueError):
+        objects.append({"object": soda.Rectangle(1, 1), "position": soda.Point(0, 0), "label": model[0]["label"]})
+
+
+def test_round_rect_geometry_is_reused():
+    soda.RoundRect.masks.clear()
+    rect = soda.RoundRect(40, 30, 8, "red", (3, 4))
+    shapes = rect.shapes_get()
+    assert rect.shapes_get() is shapes
+    canvases = [soda.Canvas((60, 50), "white") for _ in range(4)]
+    canvases[0].put(rect, (5, 6))
+    # another rectangle of the same size and radius uses the same mask
+    canvases[1].put(soda.RoundRect(40, 30, 8, "red", (3, 4)), (5, 6))
+    # the masked fill matches the pieslices and the polygon drawn one by one
+    for shape in shapes:
+        canvases[2].put(shape, (5, 6))
+    images = [canvas.render() for canvas in canvases[:3]]
+    assert soda.RoundRect.masks.cache_info()["hits"] == 1
+    assert images[0].tobytes() == images[1].tobytes() == images[2].tobytes()
+    rect.size = (20, 30)
+    assert rect.shapes_get() is not shapes
+    canvases[3].put(soda.RoundRect(20, 30, 8, "red", (3, 4)), (5, 6))
+    assert canvases[0].render().tobytes() == canvases[3].render().tobytes()
+
+
+def test_nested_canvas_is_rendered_when_it_changes():
+    inner = soda.Canvas((20, 20), "white")
+    rect = soda.Rectangle(5, 5, "red")
+    inner.put(rect, (2, 2))
+    outer = soda.Canvas((40, 40), "black")
+    outer.put(soda.SodaImage(inner), (10, 10))
+    image = inner.image_get()
+    first = outer.render().tobytes()
+    assert inner.image_get() is image
+    assert outer.render().tobytes() == first
+    rect.color_set("blue")
+    assert inner.image_get() is not image
+    changed = outer.render()
+    assert changed.getpixel((13, 13)) == (0, 0, 255, 255)
+    with pytest.raises(ValueError):
+        inner.put(soda.SodaImage(outer))
+        inner.render()
+
+
+def test_profiler_counts_renders():
+    soda.RoundRect.masks.clear()
+    seen = []
+    profiler = soda.Profiler(before=lambda entry: seen.append(entry["label"]))
+    canvas = soda.Canvas((60, 60), "white", profiler=profiler)
+    canvas.put(soda.RoundRect(10, 10, 3, "red"), label="a")
+    canvas.put(soda.RoundRect(10, 10, 3, "blue"), (20, 20), label="b")
+    canvas.put(soda.Ellipse((40, 40), 5), label="c")
+    canvas.render()
+    canvas.render()
+    stats = profiler.stats()
+    assert stats["frames"] == 2 and stats["time"] > 0
+    assert seen == ["a", "b", "c"] * 2
+    assert {key: value["count"] for key, value in stats["classes"].items()} == {"RoundRect": 4, "Ellipse": 2}
+    assert {key: value["count"] for key, value in stats["labels"].items()} == {"a": 2, "b": 2, "c": 2}
+    assert stats["caches"]["roundrect masks"] == {"hits": 3, "misses": 1}
+    assert sorted(line.split()[0] for line in profiler.flame().splitlines()) == [
+        "canvas;Ellipse:c", "canvas;RoundRect:a", "canvas;RoundRect:b"]
+    profiler.reset()
+    assert profiler.stats()["frames"] == 0 and profiler.stats()["classes"] == {}
+
+
+def badge(shape, row):
+    canvas = soda.Canvas((30, 30), "white")
+    canvas.put(shape, (15, 15))
+    return canvas
+
+
+def test_render_many_matches_single_renders(tmp_path):
+    template = soda.Template(soda.Ellipse, ["x_radius", "color"], center=(0, 0))
+    rows = [(radius, color) for radius in (3, 6, 9) for color in ("red", "blue")]
+    taken = []
+
+    def generate():
+        for row in rows:
+            taken.append(row)
+            yield row
+    output = {}
+
+    def keep(index, data):
+        # no more than the window of rows are read ahead
+        assert len(taken) <= index + 2
+        output[index] = data
+    stats = template.render_many(generate(), badge, keep, workers=2, threads=True, window=2)
+    assert stats["images"] == len(rows) and stats["bytes"] == sum(map(len, output.values()))
+    for index, row in enumerate(rows):
+        expected = badge(template(*row), row).render()
+        assert Image.open(io.BytesIO(output[index])).tobytes() == expected.tobytes()
+    template.render_many([{"x_radius": 4}], badge, str(tmp_path / "{x_radius}.png"), workers=1)
+    assert Image.open(tmp_path / "4.png").tobytes() == badge(template(4), None).render().tobytes()
+
+
+def test_scene_round_trip():
+    inner = soda.Canvas((20, 20), "yellow")
+    inner.put(soda.Ellipse((10, 10), 6, color="green"))
+    photo = Image.new("RGB", (16, 12), "purple")
+    shared = soda.Color("teal")
+    canvas = soda.Canvas((100, 80), "white")
+    canvas.put(soda.Polygon([(0, 0), (30, 5), (10, 25)], shared), (2, 3), label="polygon")
+    canvas.put(soda.Rectangle(8, 5, shared, (40, 2)))
+    canvas.put(soda.RoundRect(20, 14, 4, "red"), (60, 5))
+    canvas.put(soda.Pieslice((20, 50), 12, color="blue", start=30, stop=200))
+    canvas.put(soda.Text("Ag", FONT, 14, color="black"), (35, 40))
+    canvas.put(soda.SodaImage(photo, (70, 40)))
+    canvas.put(soda.SodaImage(photo, (80, 60), mask=Image.new("L", (16, 12), 128)))
+    canvas.put(soda.SodaImage(inner), (5, 55), label="nested")
+    canvas.put(soda.RectangleBatch([(50, 60), (55, 65)], (4, 4), ["red", "blue"]))
+    canvas.put(soda.EllipseBatch([(90, 10), (92, 20)], 3, "black"))
+    image = canvas.render().tobytes()
+    for binary in (True, False):
+        data = canvas.to_scene(binary)
+        assert isinstance(data, bytes if binary else str)
+        loaded = soda.Canvas.from_scene(data)
+        assert loaded.render().tobytes() == image
+        assert [entry["label"] for entry in loaded.objects] == [entry["label"] for entry in canvas.objects]
+        assert [type(entry["object"]) for entry in loaded.objects] == [type(entry["object"]) for entry in canvas.objects]
+        assert loaded.get("polygon")["object"].color is loaded.objects[1]["object"].color
+        loaded.get("nested")["object"].image.objects[0]["object"].color_set("black")
+        assert loaded.render().tobytes() != image
+    # shapes of other classes have to be registered
+    canvas.put(type("Dot", (soda.Ellipse,), {})((5, 5), 2))
+    with pytest.raises(TypeError):
+        canvas.to_scene()
+
+
+def test_plugins_connect_and_shapes_are_imported_on_use(tmp_path, monkeypatch):
+    (tmp_path / "soda-square.py").write_text(
+        "class Square(Rectangle):\n"
+        "    def __init__(self, side, color='black'):\n"
+        "        super().__init__(side, side, color)\n")
+    monkeypatch.setattr(soda.plugins, "paths", [str(tmp_path)])
+    monkeypatch.setattr(soda.plugins, "loaded", {})
+    monkeypatch.setattr(soda, "modules", [])
+    # an entry point of the soda.shapes group is imported on the first use of its name
+    point = metadata.EntryPoint("Counted", "collections:Counter", soda.plugins.shapes_group)
+    monkeypatch.setattr(soda.plugins, "points", {soda.plugins.group: {}, soda.plugins.shapes_group: {"Counted": point}})
+    try:
+        assert soda.plugins.available() == {"square": str(tmp_path / "soda-square.py")}
+        assert soda.connect("square, missing") == {"square": 1, "missing": -1}
+        assert soda.connect("square") == {"square": 0}
+        canvas = soda.Canvas((10, 10), "white")
+        canvas.put(soda.Square(4, "red"), (3, 3))
+        assert canvas.render().getpixel((4, 4)) == (255, 0, 0, 255) and canvas.render().getpixel((8, 8)) == (255,) * 4
+        assert "Counted" not in vars(soda)
+        assert soda.Counted is Counter and vars(soda)["Counted"] is Counter
+        with pytest.raises(AttributeError):
+            soda.Missing
+    finally:
+        for name in ("Square", "Counted"):
+            vars(soda).pop(name, None)
+
+
+def test_preview_is_rendered_at_the_scale():
+    canvas = soda.Canvas((200, 120), "white")
+    small = soda.Canvas((50, 30), "white")
+    rect = soda.Rectangle(40, 20, "red")
+    canvas.put(rect, (80, 40))
+    small.put(soda.Rectangle(10, 5, "red"), (20, 10))
+    canvas.put(soda.Ellipse((40, 80), 16, 8, "blue"))
+    small.put(soda.Ellipse((10, 20), 4, 2, "blue"))
+    canvas.put(soda.SodaImage(Image.new("RGB", (40, 40), "green"), (120, 40)))
+    small.put(soda.SodaImage(Image.new("RGB", (10, 10), "green"), (30, 10)))
+    preview = canvas.render(scale=0.25)
+    assert preview.size == (50, 30)
+    assert preview.tobytes() == small.render().tobytes()
+    # a changed shape gets a new preview, the others are kept
+    rect.color_set("black")
+    small.objects[0]["object"].color_set("black")
+    assert canvas.render(scale=0.25).tobytes() == small.render().tobytes()
+    assert canvas.render().size == (200, 120)
+
+
+def test_text_is_drawn_from_cached_masks():
+    soda.Text.bitmaps.clear()
+    texts = [soda.Text("Wj gq\nfi ÅÉ", FONT, 17, (20.4, 30.7), "cs", "red"),
+             soda.Text("Wj gq\nfi ÅÉ", FONT, 17, (20.4, 30.7), "cs", (0, 0, 255, 128)),
+             soda.Text("Wj gq\nfi ÅÉ", FONT, 17, (-13.5, 30.7), "ss", "green")]
+    for mode in ("RGBA", "RGB"):
+        expected = Image.new(mode, (80, 70), "white")
+        draw = ImageDraw.Draw(expected)
+        for text in texts:
+            draw.multiline_text(text.corners_get([text.position.x + 5, text.position.y])[0], text.text,
+                                font=text.font, fill=text.color_get(), align=text.aligns[text.align[0]])
+        image = Image.new(mode, (80, 70), "white")
+        draw = ImageDraw.Draw(image)
+        for text in texts:
+            text.render(draw, soda.Point(5, 0))
+        assert image.tobytes() == expected.tobytes(), mode
+    # the mask is shared by colors and modes, text at negative coordinates is drawn directly
+    info = soda.Text.bitmaps.cache_info()
+    assert (info["hits"], info["misses"], info["size"]) == (3, 1, 1)
+
+
+def test_resized_masks_are_shared():
+    maxsize = soda.masks.maxsize
+    soda.masks.clear()
+    source = Image.radial_gradient("L").resize((64, 64))
+    try:
+        canvas = soda.Canvas((100, 60), "white")
+        # different images with the same pixels get the same resized mask
+        canvas.put(soda.MaskShape(source, "red", size=(30, 20)), (5, 5))
+        canvas.put(soda.MaskShape(source.copy(), "blue", size=(30, 20)), (50, 5))
+        canvas.put(soda.SodaImage(Image.new("RGB", (30, 20), "green"), (20, 35), mask=source))
+        image = canvas.render()
+        info = soda.masks.cache_info()
+        assert (info["hits"], info["misses"], info["size"], info["weight"]) == (2, 1, 1, 600)
+        expected = Image.new("RGBA", (100, 60), "white")
+        draw = ImageDraw.Draw(expected)
+        mask = soda.mask_resize((30, 20), source)
+        draw.bitmap((5, 5), mask, fill="red")
+        draw.bitmap((50, 5), mask, fill="blue")
+        expected.paste(Image.new("RGB", (30, 20), "green"), (20, 35), mask)
+        assert image.tobytes() == expected.tobytes()
+        # the least recently used mask goes first once the weight is over the size
+        soda.masks.resize(900)
+        key = canvas.objects[0]["object"].mask.key_get()
+        assert soda.mask_resize((30, 20), source, key=key) is soda.mask_resize((30, 20), source, key=key)
+        small = soda.mask_resize((20, 20), source, key=key)
+        assert soda.masks.cache_info()["size"] == 1
+        assert soda.mask_resize((20, 20), source, key=key) is small
+        soda.mask_resize((30, 20), source, key=key)
+        info = soda.masks.cache_info()
+        assert (info["hits"], info["misses"], info["size"], info["weight"]) == (5, 3, 1, 600)
+    finally:
+        soda.masks.resize(maxsize)
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "RGB"])
+def test_pixels_and_arrays_of_the_current_image(mode):
+    numpy = pytest.importorskip("numpy")
+    canvas = soda.Canvas((7, 5), "white", mode, incremental=True)
+    rect = soda.Rectangle(3, 2, "black")
+    canvas.put(rect, (1, 1))
+    image = canvas.render()
+    pixels = canvas.pixels()
+    assert pixels.nbytes == 7 * 5 * len(mode) and bytes(pixels) == image.tobytes()
+    array = numpy.asarray(canvas)
+    assert array.shape == (5, 7, len(mode)) and array.dtype == numpy.uint8
+    assert array.tobytes() == image.tobytes() and not array.flags.writeable
+    # an incremental canvas changes its frame in place, the pixels taken before stay as they were
+    rect.color_set("red")
+    assert bytes(canvas.pixels()) == canvas.render().tobytes() != bytes(pixels)
+    assert numpy.asarray(canvas).tobytes() == canvas.render().tobytes()